@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+import contextlib
+import json
+import optparse
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+REPO_DIR = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' )
+sys.path.insert( 0, REPO_DIR )
+from scipy.cluster.hierarchy import linkage, fcluster
+import clusters
+import profiling
+import protein_oligo_library as oligo
+import synthetic_fasta
+
+
+def main():
+    usage = "usage: %prog [options]"
+    option_parser = optparse.OptionParser( usage )
+    add_program_options( option_parser )
+    options, arguments = option_parser.parse_args()
+
+    sizes = [ int( size ) for size in options.sizes.split( ',' ) ]
+    results = list()
+
+    for num_sequences in sizes:
+        results.extend( benchmark_size( num_sequences, options ) )
+        sys.stdout.flush()
+
+    report = { 'commit': git_commit(),
+               'timestamp': time.strftime( '%Y-%m-%dT%H:%M:%S' ),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'machine': platform.machine(),
+               'options': vars( options ),
+               'max_rss_bytes': profiling.peak_rss_bytes(),
+               'results': results
+             }
+
+    out_file = open( options.output, 'w' )
+    json.dump( report, out_file, indent = 1 )
+    out_file.close()
+
+    if options.compare is not None:
+        compare_results( options.compare, report )
+
+def benchmark_size( num_sequences, options ):
+    """
+        Runs every stage of clusters.py once on a synthetic data set of num_sequences
+        sequences, timing each stage separately
+
+        :returns: list of dictionaries, one per stage, of its timing, throughput and peak memory
+    """
+    names, sequences = synthetic_fasta.generate_protein_families( num_sequences, options.family_size,
+                                                                  options.mean_length, options.length_sigma,
+                                                                  options.mutation_rate, options.x_rate,
+                                                                  options.gap_rate, options.seed
+                                                                )
+    temp_dir = tempfile.mkdtemp()
+    fasta_file = os.path.join( temp_dir, 'synthetic.fasta' )
+    oligo.write_fastas( names, sequences, fasta_file )
+
+    window_size = options.XmerWindowSize
+    results = list()
+    state = {}
+
+    def read():
+        state[ 'names' ], state[ 'sequences' ] = oligo.read_fasta_lists( fasta_file )
+        return len( state[ 'sequences' ] )
+
+    def sort():
+        names, sequences = oligo.sort_sequences_by_length( state[ 'names' ], state[ 'sequences' ] )
+        names.reverse()
+        sequences.reverse()
+        state[ 'names' ], state[ 'sequences' ] = names, sequences
+        return len( sequences )
+
+    def xmers():
+        state[ 'ymer_dict' ] = oligo.create_ymer_dict( state[ 'sequences' ], window_size, 1, options.encode )
+        return len( state[ 'sequences' ] )
+
+    def distances():
+        num_seqs = len( state[ 'sequences' ] )
+        if options.graph:
+            state[ 'edges' ] = oligo.create_distance_edges( state[ 'sequences' ], window_size, 1, state[ 'ymer_dict' ] )
+            state[ 'out_list' ] = None
+        else:
+            state[ 'out_list' ] = oligo.create_condensed_distance_vector( state[ 'sequences' ], window_size, 1,
+                                                                          state[ 'ymer_dict' ], options.threads
+                                                                        )
+        return ( num_seqs * ( num_seqs - 1 ) ) // 2
+
+    def cluster():
+        if options.graph:
+            Z = oligo.single_linkage_from_edges( len( state[ 'sequences' ] ), *state[ 'edges' ] )
+        else:
+            Z = linkage( state[ 'out_list' ], 'single' )
+        state[ 'cluster' ] = fcluster( Z, options.clusters, criterion = 'maxclust' )
+        return len( state[ 'sequences' ] )
+
+    def stats():
+        with open( os.devnull, 'w' ) as devnull, contextlib.redirect_stdout( devnull ):
+            clusters.display_cluster_information( state[ 'cluster' ], state[ 'names' ], state[ 'sequences' ],
+                                                  state[ 'out_list' ], window_size, 1, state[ 'ymer_dict' ]
+                                                )
+        return len( state[ 'sequences' ] )
+
+    stages = [ ( 'read_fasta', read ), ( 'sort_sequences_by_length', sort ), ( 'subset_lists_iter', xmers ),
+               ( 'distances', distances ), ( 'linkage_fcluster', cluster ), ( 'display_cluster_information', stats )
+             ]
+
+    for stage_name, stage in stages:
+        seconds, items, peak_bytes = time_stage( stage, options.memory )
+        result = { 'n': num_sequences, 'stage': stage_name, 'seconds': seconds, 'items': items,
+                   'items_per_second': items / seconds if seconds > 0 else None, 'peak_bytes': peak_bytes
+                 }
+        results.append( result )
+        print( "n=%-7d %-28s %10.3fs %14.1f items/s %12s" % ( num_sequences, stage_name, seconds,
+                                                              result[ 'items_per_second' ] or 0,
+                                                              format_bytes( peak_bytes )
+                                                            )
+             )
+
+    os.remove( fasta_file )
+    os.rmdir( temp_dir )
+    return results
+
+def time_stage( stage, trace_memory = True ):
+    """
+        Runs stage, a function returning the number of items it processed
+
+        :returns: wall time in seconds, number of items, and the peak memory allocated while
+                  the stage ran in bytes, or None if trace_memory is False
+    """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    items = stage()
+    seconds = time.perf_counter() - start
+
+    peak_bytes = None
+    if trace_memory:
+        peak_bytes = tracemalloc.get_traced_memory()[ 1 ]
+        tracemalloc.stop()
+    return seconds, items, peak_bytes
+
+def compare_results( baseline_file, report ):
+    """
+        Prints the ratio of each stage's time in report to its time in baseline_file,
+        a results file from an earlier run, for the sizes both contain
+    """
+    baseline_in = open( baseline_file, 'r' )
+    baseline = json.load( baseline_in )
+    baseline_in.close()
+
+    baseline_times = { ( result[ 'n' ], result[ 'stage' ] ): result[ 'seconds' ] for result in baseline[ 'results' ] }
+
+    print( "\nCompared with %s (commit %s):" % ( baseline_file, baseline.get( 'commit' ) ) )
+    for result in report[ 'results' ]:
+        key = ( result[ 'n' ], result[ 'stage' ] )
+        if key in baseline_times and baseline_times[ key ] > 0:
+            print( "n=%-7d %-28s %8.2fx" % ( key[ 0 ], key[ 1 ], result[ 'seconds' ] / baseline_times[ key ] ) )
+
+def git_commit():
+    try:
+        return subprocess.check_output( [ 'git', 'rev-parse', 'HEAD' ], cwd = REPO_DIR,
+                                        stderr = subprocess.DEVNULL
+                                      ).decode().strip()
+    except ( OSError, subprocess.CalledProcessError ):
+        return None
+
+def format_bytes( num_bytes ):
+    if num_bytes is None:
+        return '-'
+    return "%.1f MB" % ( num_bytes / ( 1024 * 1024 ) )
+
+def add_program_options( options ):
+    options.add_option( '-s', '--sizes', help = "Comma-separated numbers of sequences to benchmark. [1000,2000,5000,10000,20000,50000]",
+                        default = "1000,2000,5000,10000,20000,50000"
+                      )
+    options.add_option( '-o', '--output', help = "JSON file to write results to. [benchmark_results.json]",
+                        default = "benchmark_results.json"
+                      )
+    options.add_option( '--compare', help = "Results file of an earlier run to print time ratios against. [None]" )
+    options.add_option( '-x', '--XmerWindowSize', help = "Size of xmers to compare sequences with. [19]", default = 19, type = int )
+    options.add_option( '-c', '--clusters', help = "Maximum number of clusters to produce. [100]", default = 100, type = int )
+    options.add_option( '-t', '--threads', help = "Number of processes to compute distances with. [1]", default = 1, type = int )
+    options.add_option( '--encode', help = "Use packed integer xmers. [False]", action = 'store_true', default = False )
+    options.add_option( '--graph', help = "Cluster from the graph of pairs sharing xmers. [False]", action = 'store_true',
+                        default = False
+                      )
+    options.add_option( '--no_memory', help = "Do not trace peak memory of each stage, which slows down pure Python stages. [False]",
+                        action = 'store_false', dest = 'memory', default = True
+                      )
+
+    options.add_option( '--family_size', help = "Average number of sequences per family. [10]", default = 10, type = int )
+    options.add_option( '--mean_length', help = "Median length of each family's ancestor. [300]", default = 300, type = int )
+    options.add_option( '--length_sigma', help = "Sigma of the log-normal ancestor length distribution. [0.5]",
+                        default = 0.5, type = float
+                      )
+    options.add_option( '--mutation_rate', help = "Probability of each residue being substituted. [0.05]", default = 0.05,
+                        type = float
+                      )
+    options.add_option( '--x_rate', help = "Probability of each residue being an 'X'. [0.0]", default = 0.0, type = float )
+    options.add_option( '--gap_rate', help = "Probability of each residue being a '-'. [0.0]", default = 0.0, type = float )
+    options.add_option( '--seed', help = "Random seed of the synthetic sequences. [0]", default = 0, type = int )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import optparse
+import os
+import sys
+import numpy as np
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..' ) )
+import protein_oligo_library as oligo
+
+AMINO_ACIDS = np.frombuffer( b'ACDEFGHIKLMNPQRSTVWY', dtype = np.uint8 )
+
+
+def main():
+    usage = "usage: %prog [options]"
+    option_parser = optparse.OptionParser( usage )
+    add_program_options( option_parser )
+    options, arguments = option_parser.parse_args()
+
+    names, sequences = generate_protein_families( options.num_sequences, options.family_size, options.mean_length,
+                                                  options.length_sigma, options.mutation_rate, options.x_rate,
+                                                  options.gap_rate, options.seed
+                                                )
+    oligo.write_fastas( names, sequences, options.output )
+
+def generate_protein_families( num_sequences, family_size = 10, mean_length = 300, length_sigma = 0.5,
+                               mutation_rate = 0.05, x_rate = 0.0, gap_rate = 0.0, seed = 0, min_length = 50,
+                               num_species = 50 ):
+    """
+        Generates a reproducible set of synthetic protein sequences made of families, each family
+        being point mutants of one random ancestor.
+
+        :param num_sequences: integer number of sequences to generate
+        :param family_size: integer average number of sequences per family
+        :param mean_length: integer median length of the ancestors, whose lengths are log-normal
+        :param length_sigma: float sigma of the log-normal ancestor length distribution
+        :param mutation_rate: float probability of each residue of a member being substituted
+        :param x_rate: float probability of each residue being replaced by an 'X'
+        :param gap_rate: float probability of each residue being replaced by a '-'
+        :param seed: integer seed, the same seed always gives the same sequences
+        :param min_length: integer minimum ancestor length
+        :param num_species: integer number of distinct TaxIDs to assign names
+
+        :returns: list of names, in uniref style with a TaxID, and list of sequences
+    """
+    generator = np.random.default_rng( seed )
+    num_families = max( num_sequences // family_size, 1 )
+
+    lengths = np.maximum( generator.lognormal( np.log( mean_length ), length_sigma, num_families ).astype( int ),
+                          min_length
+                        )
+    ancestors = [ generator.choice( AMINO_ACIDS, size = length ) for length in lengths ]
+    family_species = generator.integers( 1, num_species + 1, size = num_families )
+
+    names = list()
+    sequences = list()
+    for index in range( num_sequences ):
+        family = generator.integers( num_families )
+        member = ancestors[ family ].copy()
+
+        draws = generator.random( len( member ) )
+        mutated = draws < mutation_rate
+        member[ mutated ] = generator.choice( AMINO_ACIDS, size = np.count_nonzero( mutated ) )
+        member[ ( draws >= mutation_rate ) & ( draws < mutation_rate + x_rate ) ] = ord( 'X' )
+        member[ ( draws >= mutation_rate + x_rate ) & ( draws < mutation_rate + x_rate + gap_rate ) ] = ord( '-' )
+
+        names.append( "Synthetic_%d n=1 Tax=family_%d TaxID=%d RepID=SYN%d" % ( index, family, family_species[ family ], index ) )
+        sequences.append( member.tobytes().decode() )
+
+    return names, sequences
+
+def add_program_options( options ):
+    options.add_option( '-n', '--num_sequences', help = "Number of sequences to generate. [1000]", default = 1000, type = int )
+    options.add_option( '-o', '--output', help = "Fasta file to write, compressed if it ends in .gz. [synthetic.fasta]",
+                        default = "synthetic.fasta"
+                      )
+    options.add_option( '--family_size', help = "Average number of sequences per family. [10]", default = 10, type = int )
+    options.add_option( '--mean_length', help = "Median length of each family's ancestor. [300]", default = 300, type = int )
+    options.add_option( '--length_sigma', help = "Sigma of the log-normal ancestor length distribution. [0.5]",
+                        default = 0.5, type = float
+                      )
+    options.add_option( '--mutation_rate', help = "Probability of each residue of a member being substituted. [0.05]",
+                        default = 0.05, type = float
+                      )
+    options.add_option( '--x_rate', help = "Probability of each residue being an 'X'. [0.0]", default = 0.0, type = float )
+    options.add_option( '--gap_rate', help = "Probability of each residue being a '-'. [0.0]", default = 0.0, type = float )
+    options.add_option( '--seed', help = "Random seed. [0]", default = 0, type = int )
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,22 @@
 #!/usr/bin/env python3
 
-from matplotlib import pyplot as plt
-from scipy.cluster.hierarchy import dendrogram, linkage, fcluster
 import numpy as np 
+import copy
+import json
 import optparse
+import os
 import sys
+import tempfile
 import protein_oligo_library as oligo
+import distance_cache
+import distance_output
+import distance_shards
+import profiling
+import run_state
+import taxonomy
+
+# scipy and matplotlib are imported by the stages that use them, so that --help, and
+# runs that never plot, do not wait on them
 
 
 def main():
@@ -14,129 +25,720 @@ def main():
     add_program_options( option_parser )
     options, arguments = option_parser.parse_args()
 
-
-    if options.query is None:
-        print( "ERROR: Fasta query file must be provided." )
+    try:
+        run( options )
+    except ValueError as error:
+        print( "ERROR: %s." % error )
         sys.exit( 0 )
 
-    names, sequences = oligo.read_fasta_lists( options.query )
-    names, sequences = oligo.sort_sequences_by_length( names, sequences )
-
-    cluster_dict = {}
-
-    # Get the sequences sorted in decreasing order
-    names.reverse()
-    sequences.reverse()
+def validate_options( options ):
+    """
+        Checks that options can be run together
 
-    num_seqs = len( sequences )
-
-    ymer_dict = {}
-    for index in range( num_seqs ):
-        ymer_dict[ sequences[ index ] ] = oligo.subset_lists_iter( sequences[ index ], options.XmerWindowSize, 1 )
+        :raises ValueError: naming the first problem found
+    """
+    if options.query is None:
+        raise ValueError( "Fasta query file must be provided" )
+
+    if options.approximate and options.sketch_size % options.bands:
+        raise ValueError( "Sketch size must be divisible by the number of bands" )
+
+    if options.approximate and ( options.save_state is not None or options.append is not None or
+                                 options.build_reference is not None or options.reference is not None ):
+        raise ValueError( "Saved runs and references are only supported with exact distances" )
+
+    if options.shard is not None or options.merge:
+        if options.shard is not None and options.merge:
+            raise ValueError( "Shards are computed with --shard and merged with --merge in separate runs" )
+        if options.approximate or options.greedy or options.sweep_windows is not None or options.append is not None:
+            raise ValueError( "Sharded distances cannot be combined with --approximate, --greedy, --sweep_windows, or --append" )
+        if options.shard is not None:
+            distance_shards.parse_shard( options.shard )
+
+    if options.greedy:
+        if options.distance_threshold is None:
+            raise ValueError( "--greedy needs --distance_threshold, the maximum distance of a sequence to its representative" )
+        if options.graph or options.approximate or options.sweep_windows is not None or options.append is not None or \
+           options.save_state is not None or options.dendrogram is not None:
+            raise ValueError( "--greedy cannot be combined with --graph, --approximate, --sweep_windows, --append, "
+                              "--save_state, or --dendrogram" )
+
+    if options.distance_output is not None and ( options.graph or options.greedy or options.append is not None ):
+        raise ValueError( "--distance_output needs the full distance matrix, which is not computed with --graph, --greedy, or --append" )
+
+    if ( options.distance_output is not None or options.edge_output is not None ) and options.sweep_windows is not None:
+        raise ValueError( "Distances cannot be written with --sweep_windows" )
+
+    if options.species_file is not None and options.species_table is None:
+        raise ValueError( "--species_file is compiled into the directory given by --species_table, which must be provided" )
+
+    if options.sweep_windows is not None:
+        parse_int_list( options.sweep_windows )
+    if options.sweep_clusters is not None:
+        parse_int_list( options.sweep_clusters )
+
+def default_options( **option_values ):
+    """
+        Gets the options of clusters.py at their defaults, for running the pipeline from Python,
+        e.g. run( default_options( query = 'in.fasta', clusters = 10 ) )
+
+        :param option_values: values of options to set, by the names run reads them with
+    """
+    option_parser = optparse.OptionParser()
+    add_program_options( option_parser )
+    options = option_parser.get_default_values()
+
+    for name, value in option_values.items():
+        if not hasattr( options, name ):
+            raise ValueError( "Unknown option '%s'" % name )
+        setattr( options, name, value )
+    return options
+
+def run( options, profiler = None ):
+    """
+        Runs every stage of clusters.py: reads and filters the sequences of options.query,
+        takes their xmers, computes their distances, clusters them, then writes the clusters,
+        and the dendrogram and statistics if asked for. Each stage is also a function of
+        this module that can be called on its own.
+
+        :param options: options from the command line or from default_options
+        :param profiler: profiling.StageProfiler to record the stages with, one is created
+                         if none is provided
+
+        :raises ValueError: if the options cannot be run together, see validate_options, or
+                            a saved run, reference, species table, or shards cannot be used
+
+        :returns: lists of the names and sequences clustered, in output order, and numpy
+                  array of the cluster of each, or None with --sweep_windows. All three
+                  are None with --build_reference or --reference.
+    """
+    validate_options( options )
+
+    if profiler is None:
+        profiler = profiling.StageProfiler( options.progress_interval )
+    if options.profile is not None:
+        oligo.set_progress_callback( profiler.progress )
+
+    if options.build_reference is not None or options.reference is not None:
+        if options.build_reference is not None:
+            build_reference( options, profiler )
+        else:
+            query_reference( options, profiler )
+        finish_profiling( options, profiler )
+        return None, None, None
+
+    species_table = None
+    if options.verbose and options.species_table is not None:
+        species_table = load_species_table( options, profiler )
+
+    with profiler.stage( 'read_fasta' ) as record:
+        names, sequences = read_sequences( options.query )
+        record[ 'items' ] = len( sequences )
+
+    if options.min_length is not None or options.percent_valid is not None:
+        with profiler.stage( 'filter_sequences', len( sequences ) ) as record:
+            names, sequences = filter_sequences( names, sequences, options.min_length, options.percent_valid )
+            record[ 'kept' ] = len( sequences )
+
+    if options.shard is not None:
+        compute_distance_shard( options, sequences, profiler )
+        finish_profiling( options, profiler )
+        return None, None, None
 
     num_seqs = len( sequences )
-    out_list = np.empty( 1 )
-
-    for current_seq in range( num_seqs ):
-        for inner_index in range( current_seq + 1, num_seqs ):
-            out_list = np.append( out_list,
-                                  oligo.get_single_sequence_dist( ymer_dict[ sequences[ current_seq ] ],
-                                                                  ymer_dict[ sequences[ inner_index ] ], options.XmerWindowSize, 1
-                                                                )
-                                )
-            
-    out_list = np.delete( out_list, 0 )
+    window_size = options.XmerWindowSize
+    cluster = None
+
+    if options.sweep_windows is not None:
+        sweep_clusters( options, names, sequences, profiler )
+    else:
+        # A scratch file holds a whole distance vector, so it is removed even if a stage fails
+        scratch_file = None
+        try:
+            if options.append is not None:
+                names, sequences, Z, window_size = append_to_run( options, names, sequences, profiler )
+                out_list = None
+                ymer_dict = None
+                num_seqs = len( sequences )
+            elif options.greedy:
+                Z = None
+                out_list = None
+                ymer_dict = extract_xmers( options, sequences, profiler )
+
+                with profiler.stage( 'greedy_clusters', num_seqs ) as record:
+                    cluster, representatives = oligo.greedy_clusters( sequences, options.XmerWindowSize, 1,
+                                                                      options.distance_threshold, ymer_dict
+                                                                    )
+                    record[ 'clusters' ] = len( representatives )
+
+                if options.representatives is not None:
+                    oligo.write_fastas( [ names[ index ] for index in representatives ],
+                                        [ sequences[ index ] for index in representatives ], options.representatives
+                                      )
+            else:
+                Z, out_list, ymer_dict, scratch_file = cluster_linkage( options, sequences, profiler )
+
+                if options.save_state is not None:
+                    with profiler.stage( 'save_state', num_seqs ):
+                        if ymer_dict is None:
+                            ymer_dict = oligo.create_ymer_dict( sequences, options.XmerWindowSize, 1, options.encode )
+                        xmer_index = oligo.XmerIndex( sequences, options.XmerWindowSize, 1, ymer_dict )
+                        run_state.save_state( options.save_state, names, sequences, options.XmerWindowSize, 1, xmer_index, Z )
+
+            if Z is not None:
+                with profiler.stage( 'fcluster', num_seqs ):
+                    cluster = cut_clusters( Z, options.clusters, options.distance_threshold )
+
+            if options.verbose:
+                print( "Clustering Complete" )
+
+            with profiler.stage( 'write_output', num_seqs ):
+                write_clusters( names, cluster, options.output )
+
+            if options.distance_output is not None or options.edge_output is not None:
+                export_distances( options, names, sequences, out_list, ymer_dict, profiler )
+
+            if options.dendrogram is not None:
+                with profiler.stage( 'dendrogram', num_seqs ):
+                    plot_dendrogram( Z, names, options.dendrogram )
+
+            if options.verbose:
+                with profiler.stage( 'display_cluster_information', num_seqs ):
+                    display_cluster_information( cluster, names, sequences, out_list, window_size, 1, ymer_dict,
+                                                 options.stats_output, species_table
+                                               )
+        finally:
+            remove_scratch_file( scratch_file )
+
+    finish_profiling( options, profiler )
+    return names, sequences, cluster
+
+def remove_scratch_file( scratch_file ):
+    """
+        Removes the scratch file backing a distance vector, if there is one
+    """
+    if scratch_file is not None and os.path.exists( scratch_file ):
+        os.remove( scratch_file )
+
+def finish_profiling( options, profiler ):
+    if options.profile is not None:
+        oligo.set_progress_callback( None )
+        profiler.write_json( options.profile )
+
+def build_reference( options, profiler ):
+    """
+        Indexes the sequences of options.query and saves the index to options.build_reference,
+        for finding the references nearest to query sequences with query_reference
+    """
+    with profiler.stage( 'read_fasta' ) as record:
+        names, sequences = oligo.read_fasta_lists( options.query )
+        record[ 'items' ] = len( sequences )
+
+    ymer_dict = extract_xmers( options, sequences, profiler )
+    with profiler.stage( 'xmer_index', len( sequences ) ):
+        xmer_index = oligo.XmerIndex( sequences, options.XmerWindowSize, 1, ymer_dict )
+
+    with profiler.stage( 'save_reference', len( sequences ) ):
+        run_state.save_reference( options.build_reference, names, sequences, options.XmerWindowSize, 1, xmer_index )
 
     if options.verbose:
-        print( "Distance Matrix complete" )
+        print( "Indexed %d reference sequences in %s" % ( len( sequences ), options.build_reference ) )
+
+def query_reference( options, profiler ):
+    """
+        Finds the options.top_k references of options.reference nearest to each sequence of
+        options.query, streaming the queries in batches. Writes a tab-delimited line to
+        options.output per query and reference found, its query name, reference name, and
+        distance, with the references of each query from nearest to farthest.
+    """
+    with profiler.stage( 'load_reference' ) as record:
+        reference = run_state.load_reference( options.reference )
+        reference_names = reference[ 'names' ]
+        record[ 'items' ] = len( reference_names )
 
-    Z = linkage( out_list, 'single' )
+    out_file = open( options.output, 'w' )
+    with profiler.stage( 'nearest_references' ) as record:
+        num_queries = 0
+        num_found = 0
+        for names, query, found, distances in oligo.query_nearest_references( reference[ 'xmer_index' ],
+                                                                              oligo.read_fasta( options.query ),
+                                                                              options.top_k, options.max_distance,
+                                                                              options.query_batch, options.threads
+                                                                            ):
+            for index in range( len( query ) ):
+                out_file.write( "%s\t%s\t%s\n" % ( names[ query[ index ] ], reference_names[ found[ index ] ],
+                                                    distances[ index ]
+                                                  )
+                              )
+            num_queries += len( names )
+            num_found += len( query )
+        record[ 'items' ] = num_queries
+        record[ 'neighbors' ] = num_found
+    out_file.close()
 
-    cluster = fcluster( Z, options.clusters, criterion ='maxclust' )
+def read_sequences( file_name ):
+    """
+        Reads the sequences of a fasta file, longest first, the order they are clustered in
 
-    out_file = open( options.output, 'w' )
+        :returns: list of names and list of sequences
+    """
+    names, sequences = oligo.read_fasta_lists( file_name )
+    names, sequences = oligo.sort_sequences_by_length( names, sequences )
 
-    if options.verbose:
-        print( "Clustering Complete" )
-    
+    # Get the sequences sorted in decreasing order
+    names.reverse()
+    sequences.reverse()
+    return names, sequences
+
+def filter_sequences( names, sequences, min_length = None, percent_valid = None ):
+    """
+        Keeps only the sequences that are valid as defined by oligo.is_valid_sequence,
+        those with no 'X' and either a run of at least min_length characters between
+        gaps, or if min_length is None, less than 100 - percent_valid percent gaps.
+        The names and sequences kept are unchanged.
+
+        :returns: list of names and list of sequences that are valid, in their original order
+    """
+    sequence_buffer, offsets = oligo.create_sequence_buffer( sequences )
+    valid = oligo.valid_sequence_mask( sequence_buffer, offsets, min_length, percent_valid )
+
+    valid_names = [ names[ index ] for index in np.flatnonzero( valid ) ]
+    valid_sequences = [ sequences[ index ] for index in np.flatnonzero( valid ) ]
+    return valid_names, valid_sequences
+
+def cut_clusters( Z, num_clusters, distance_threshold = None ):
+    """
+        Cuts the linkage Z into at most num_clusters clusters, or if distance_threshold is
+        provided, into the clusters whose members are joined at most that distance apart
+
+        :returns: numpy array of the cluster of each item, numbered from 1
+    """
+    from scipy.cluster.hierarchy import fcluster
+
+    if distance_threshold is not None:
+        return fcluster( Z, distance_threshold, criterion = 'distance' )
+    return fcluster( Z, num_clusters, criterion ='maxclust' )
+
+def write_clusters( names, cluster, file_name ):
+    """
+        Writes one line per sequence to file_name, its cluster followed by its name
+    """
+    out_file = open( file_name, 'w' )
     for sequence in range( len( names ) ):
-        if cluster[ sequence ] not in cluster_dict:
-            cluster_dict[ cluster[ sequence ] ] = list()
-        cluster_dict[ cluster[ sequence ] ].append( ( names[ sequence ], sequences[ sequence ] ) )
-            
         out_file.write( "%d %s\n" % ( cluster[ sequence ], names[ sequence ] ) )
-
-    if options.verbose:
-        display_cluster_information( cluster_dict, out_list, options.XmerWindowSize, 1, ymer_dict )
-
     out_file.close()
 
-                                        
-
-def display_cluster_information( cluster_dict, list_of_distances, window_size, step_size, ymer_dict = None ):
-
-    dict_values = cluster_dict.values()
-
-    clusters_total = 0
-    cluster_seqs = 0
-
-    avg_distance = 0 
-    max_distance = 0
-    min_distance = len( dict_values )
-
-    # Viral stats
-    avg_species_per_cluster = 0
-    num_species = 0
-    species_from_sequences = set()
-    species_per_cluster = {}
+def export_distances( options, names, sequences, out_list, ymer_dict, profiler ):
+    """
+        Writes the distances of sequences to options.distance_output as a condensed vector,
+        and to options.edge_output as an edge list of the pairs at most options.edge_max_distance
+        apart, streaming both to disk. Without a condensed vector, as with --graph or --append,
+        the edges are computed again one tile at a time.
+    """
+    if options.distance_output is not None:
+        with profiler.stage( 'distance_output', len( out_list ) ):
+            distance_output.write_condensed_vector( options.distance_output, out_list, names )
+
+    if options.edge_output is not None:
+        with profiler.stage( 'edge_output' ) as record:
+            if out_list is not None:
+                edge_chunks = oligo.condensed_edge_chunks( out_list, len( sequences ), options.edge_max_distance )
+            else:
+                window_size = options.XmerWindowSize
+                encode = options.encode
+                if options.append is not None:
+                    meta = run_state.load_meta( options.append )
+                    window_size = meta[ 'window_size' ]
+                    encode = meta[ 'encode' ]
+                    ymer_dict = None
+                if ymer_dict is None:
+                    ymer_dict = oligo.create_ymer_dict( sequences, window_size, 1, encode )
+                edge_chunks = oligo.distance_edge_chunks( sequences, window_size, 1, ymer_dict,
+                                                          max_distance = options.edge_max_distance
+                                                        )
+            record[ 'edges' ] = distance_output.write_edge_list( options.edge_output, edge_chunks, names )
+
+def plot_dendrogram( Z, names, file_name, max_labels = 100 ):
+    """
+        Plots the dendrogram of the linkage Z to file_name, in the image format of its
+        extension. Leaves are labeled with names when there are at most max_labels of them.
+    """
+    import matplotlib
+    matplotlib.use( 'Agg' )
+    from matplotlib import pyplot as plt
+    from scipy.cluster.hierarchy import dendrogram
+
+    figure = plt.figure( figsize = ( 12, 6 ) )
+    if len( names ) <= max_labels:
+        dendrogram( Z, labels = names, leaf_rotation = 90 )
+    else:
+        dendrogram( Z, no_labels = True )
+    plt.ylabel( 'Distance' )
+    plt.tight_layout()
+    figure.savefig( file_name )
+    plt.close( figure )
+
+def cluster_linkage( options, sequences, profiler, sequence_codes = None ):
+    """
+        Computes the single linkage clustering of sequences, from the full distance matrix
+        or from the graph of pairs sharing xmers, as the options ask for
+
+        :returns: linkage matrix Z, condensed distance vector or None with --graph, dictionary
+                  of sequence: xmers if one was made, and the name of the scratch file backing
+                  the distance vector, if any
+    """
+    num_seqs = len( sequences )
+    num_pairs = ( num_seqs * ( num_seqs - 1 ) ) // 2
+
+    out_list = None
+    ymer_dict = None
+    scratch_file = None
+
+    if options.merge:
+        with profiler.stage( 'merge_shards', num_pairs ):
+            metas = distance_shards.load_shard_metas( options.shard_dir, num_seqs, input_hash( options ) )
+            if ( metas[ 0 ][ 'kind' ] == 'edges' ) != options.graph:
+                raise ValueError( "Shards computed with --graph can only be merged with --graph, and the others only without" )
+            if metas[ 0 ][ 'window_size' ] != options.XmerWindowSize:
+                raise ValueError( "The shards were computed with a window size of %d" % metas[ 0 ][ 'window_size' ] )
+            # Pairs further apart than the shards kept are missing, so only cuts at or below it are exact
+            max_distance = metas[ 0 ].get( 'max_distance' )
+            if max_distance is not None and ( options.distance_threshold is None or options.distance_threshold > max_distance ):
+                raise ValueError( "The shards only kept edges at most %s apart, so they must be merged with a "
+                                  "--distance_threshold of at most %s" % ( max_distance, max_distance ) )
+
+            if options.graph:
+                first, second, distances = distance_shards.merge_edges( options.shard_dir, metas )
+            else:
+                dtype = metas[ 0 ][ 'dtype' ]
+                try:
+                    if options.scratch_dir is not None:
+                        file_handle, scratch_file = tempfile.mkstemp( prefix = 'distances_', suffix = '.dat', dir = options.scratch_dir )
+                        os.close( file_handle )
+                        out_list = oligo.create_distance_vector_file( scratch_file, num_seqs, dtype )
+                    else:
+                        out_list = np.empty( num_pairs, dtype = dtype )
+                    distance_shards.merge_vector( options.shard_dir, metas, out_list )
+                except BaseException:
+                    remove_scratch_file( scratch_file )
+                    raise
+
+        from scipy.cluster.hierarchy import linkage
+
+        try:
+            with profiler.stage( 'linkage', num_seqs ):
+                if options.graph:
+                    Z = oligo.single_linkage_from_edges( num_seqs, first, second, distances )
+                else:
+                    Z = linkage( oligo.dequantize_distances( out_list ), 'single' )
+        except BaseException:
+            remove_scratch_file( scratch_file )
+            raise
+        return Z, out_list, ymer_dict, scratch_file
+
+    if options.graph:
+        # Only the pairs sharing xmers are kept, as edges of a graph, and never a full matrix
+        if options.approximate:
+            with profiler.stage( 'distance_edges', num_pairs ) as record:
+                first, second, distances = oligo.approximate_distance_edges( sequences, options.XmerWindowSize, 1,
+                                                                             options.sketch_size, options.bands,
+                                                                             num_threads = options.threads
+                                                                           )
+                record[ 'edges' ] = len( distances )
+        else:
+            # A saved run keeps every edge, so that it can later be cut at any distance
+            max_distance = options.distance_threshold
+            if options.save_state is not None:
+                max_distance = None
+
+            ymer_dict = extract_xmers( options, sequences, profiler, sequence_codes )
+            with profiler.stage( 'distance_edges', num_pairs ) as record:
+                first, second, distances = oligo.create_distance_edges( sequences, options.XmerWindowSize, 1, ymer_dict,
+                                                                        max_distance = max_distance
+                                                                      )
+                record[ 'edges' ] = len( distances )
+        if options.verbose:
+            print( "Distance graph complete, %d edges" % len( distances ) )
+
+        with profiler.stage( 'linkage', num_seqs ):
+            Z = oligo.single_linkage_from_edges( num_seqs, first, second, distances )
+    else:
+        out_list, ymer_dict, scratch_file = compute_distances( options, sequences, profiler, sequence_codes )
+
+        if options.verbose:
+            print( "Distance Matrix complete" )
+
+        from scipy.cluster.hierarchy import linkage
+
+        try:
+            with profiler.stage( 'linkage', num_seqs ):
+                # linkage itself works on an in-memory float64 copy of the distances
+                Z = linkage( oligo.dequantize_distances( out_list ), 'single' )
+        except BaseException:
+            remove_scratch_file( scratch_file )
+            raise
+
+    return Z, out_list, ymer_dict, scratch_file
+
+def append_to_run( options, names, sequences, profiler ):
+    """
+        Adds sequences to the run saved in options.append, computing only their distances
+        to the saved sequences and to each other. Xmers are taken with the window size
+        and encoding of the saved run.
+
+        :returns: lists of the names and sequences of the run, saved followed by new,
+                  the single linkage matrix of all of them, and the window size of the run
+    """
+    meta = run_state.load_meta( options.append )
+
+    append_options = copy.copy( options )
+    append_options.XmerWindowSize = meta[ 'window_size' ]
+    append_options.encode = meta[ 'encode' ]
+    ymer_dict = extract_xmers( append_options, sequences, profiler )
+
+    with profiler.stage( 'append', len( sequences ) ) as record:
+        names, sequences, Z = run_state.append_sequences( options.append, names, sequences, ymer_dict )
+        record[ 'saved_sequences' ] = meta[ 'num_items' ]
 
-    
+    if options.verbose:
+        print( "Added %d sequences to the %d of %s" % ( len( sequences ) - meta[ 'num_items' ], meta[ 'num_items' ],
+                                                         options.append
+                                                       )
+             )
+    return names, sequences, Z, meta[ 'window_size' ]
+
+def load_species_table( options, profiler ):
+    """
+        Loads the species table of options.species_table, compiling it from
+        options.species_file first if that is provided
+    """
+    with profiler.stage( 'species_table' ):
+        if options.species_file is not None:
+            return taxonomy.build_species_table( options.species_file, options.species_table )
+        return taxonomy.load_species_table( options.species_table )
+
+def input_hash( options ):
+    """
+        Identifies the sequences options.query and the filter options give, so that shards of
+        different inputs are never merged
+    """
+    return "%s|%s|%s" % ( distance_cache.file_content_hash( options.query ), options.min_length, options.percent_valid )
+
+def compute_distance_shard( options, sequences, profiler ):
+    """
+        Computes shard options.shard, given as i/N, of the distances of sequences and writes
+        it to options.shard_dir. Shards split the rows of the distance matrix by their cost,
+        and once all N are written, they are clustered together with --merge.
+    """
+    shard, num_shards = distance_shards.parse_shard( options.shard )
+
+    ymer_dict = extract_xmers( options, sequences, profiler )
+    with profiler.stage( 'xmer_index', len( sequences ) ):
+        xmer_index = oligo.XmerIndex( sequences, options.XmerWindowSize, 1, ymer_dict )
+
+    with profiler.stage( 'distance_shard' ) as record:
+        meta = distance_shards.compute_shard( options.shard_dir, shard, num_shards, xmer_index, input_hash( options ),
+                                              options.graph, options.distance_threshold, options.distance_dtype
+                                            )
+        record[ 'items' ] = oligo.pairs_in_rows( len( sequences ), meta[ 'start' ], meta[ 'end' ] )
 
-    # Cluster stats
-    num_clusters = len( cluster_dict.keys() )
-    min_cluster_size = min( [ len( item ) for item in dict_values ] )
-    max_cluster_size = max( [ len( item ) for item in dict_values ] )
-    avg_cluster_size = sum( [ len( item ) for item in dict_values ] ) / num_clusters
-
-    # Distance stats
-    for key, item in cluster_dict.items():
-        names = [ seq[ 0 ] for seq in item ]
-        for current_name in names:
-            id = oligo.get_taxid_from_name( current_name )
-            species_from_sequences.add( id )
-
-            if key not in species_per_cluster:
-                species_per_cluster[ key ] = set()
-            species_per_cluster[ key ].add( id )
-
-        current_matrix = oligo.create_distance_matrix_of_sequences( [ seq[ 1 ] for seq in item ], window_size,
-                                                                    step_size, ymer_dict 
-
-                                                                  )
-        if len( item ) > 1:
-            matrix_array = list()
-            for current_distance in range( len( current_matrix ) ):
-                for local_distance in range( current_distance + 1, len( current_matrix ) ):
-                    matrix_array.append( current_matrix[ current_distance ][ local_distance ] )
-                    
-            clusters_total += sum( matrix_array )
-            cluster_seqs += len( matrix_array )
-
-            local_max = max( matrix_array )
-            local_min = min( matrix_array )
-
-            max_distance = max( local_max, max_distance )
-            min_distance = min( local_min, min_distance )
-
-    num_species = len( species_from_sequences )
-    avg_distance = clusters_total / cluster_seqs
-    avg_species_per_cluster = ( sum( [ len( item ) for item in species_per_cluster.values() ] ) / num_clusters )
+    if options.verbose:
+        print( "Shard %d of %d computed, rows %d to %d" % ( shard, num_shards, meta[ 'start' ], meta[ 'end' ] ) )
+
+def sweep_clusters( options, names, sequences, profiler ):
+    """
+        Clusters sequences for every window size of options.sweep_windows, cutting each
+        window's linkage into every cluster count of options.sweep_clusters. The distances
+        and linkage of each window size are computed once for all of its cluster counts.
+        Only the encoding of the characters of each sequence, with --encode, is shared
+        between window sizes; the xmers are taken again for each. Writes one line per sequence
+        to options.output, with the cluster of the sequence for each window size and count.
+    """
+    window_sizes = parse_int_list( options.sweep_windows )
+    if options.sweep_clusters is not None:
+        cluster_counts = parse_int_list( options.sweep_clusters )
+    else:
+        cluster_counts = [ options.clusters ]
+
+    sequence_codes = None
+    if options.encode:
+        with profiler.stage( 'encode_sequences', len( sequences ) ):
+            sequence_codes = { sequence: oligo.encode_sequence( sequence ) for sequence in sequences }
+
+    header = [ 'Name' ]
+    columns = list()
+    for window_size in window_sizes:
+        window_options = copy.copy( options )
+        window_options.XmerWindowSize = window_size
+        # Every column is cut by cluster count, which needs every edge of the graph
+        window_options.distance_threshold = None
+
+        Z, out_list, ymer_dict, scratch_file = cluster_linkage( window_options, sequences, profiler, sequence_codes )
+        del ymer_dict
+
+        try:
+            with profiler.stage( 'fcluster', len( sequences ) * len( cluster_counts ) ):
+                for num_clusters in cluster_counts:
+                    header.append( "x%d_c%d" % ( window_size, num_clusters ) )
+                    columns.append( cut_clusters( Z, num_clusters ) )
+        finally:
+            del out_list
+            remove_scratch_file( scratch_file )
+
+        if options.verbose:
+            print( "Clustering complete for window size %d" % window_size )
+
+    with profiler.stage( 'write_output', len( sequences ) ):
+        out_file = open( options.output, 'w' )
+        out_file.write( "\t".join( header ) + "\n" )
+        for index in range( len( names ) ):
+            out_file.write( names[ index ] + "\t" + "\t".join( str( column[ index ] ) for column in columns ) + "\n" )
+        out_file.close()
+
+def parse_int_list( int_list ):
+    """
+        Parses a comma-separated string of integers into a list of integers
+    """
+    try:
+        return [ int( item ) for item in int_list.split( ',' ) if item.strip() ]
+    except ValueError:
+        raise ValueError( "Expected a comma-separated list of integers, got '%s'" % int_list )
+
+def extract_xmers( options, sequences, profiler, sequence_codes = None ):
+    """
+        Creates the dictionary of sequence: xmers of sequences, as a profiled stage
+
+        :returns: dictionary of sequence: xmers
+    """
+    with profiler.stage( 'subset_lists_iter', len( sequences ) ) as record:
+        ymer_dict = oligo.create_ymer_dict( sequences, options.XmerWindowSize, 1, options.encode, sequence_codes )
+        if sequences:
+            record[ 'xmers_per_sequence' ] = sum( len( xmers ) for xmers in ymer_dict.values() ) / len( ymer_dict )
+    return ymer_dict
+
+def compute_distances( options, sequences, profiler, sequence_codes = None ):
+    """
+        Computes the condensed distance vector of sequences as the options ask for, reusing
+        a cached vector if there is one
+
+        :returns: condensed distance vector, dictionary of sequence: xmers if one was made,
+                  and the name of the scratch file backing the vector, if any
+    """
+    num_seqs = len( sequences )
+    num_pairs = ( num_seqs * ( num_seqs - 1 ) ) // 2
+    scratch_file = None
+
+    if options.approximate:
+        distance_mode = "approximate|%d|%d" % ( options.sketch_size, options.bands )
+    else:
+        distance_mode = "exact"
+    if options.distance_dtype != 'float64':
+        distance_mode += "|" + options.distance_dtype
+    if options.encode and not options.approximate:
+        distance_mode += "|encode"
+    # Filtered runs cluster fewer sequences of the same file
+    if options.min_length is not None or options.percent_valid is not None:
+        distance_mode += "|filter|%s|%s" % ( options.min_length, options.percent_valid )
+
+    out_list = None
+    ymer_dict = None
+    if options.cache_dir is not None:
+        with profiler.stage( 'cache_lookup' ) as record:
+            key = distance_cache.cache_key( options.query, options.XmerWindowSize, 1, distance_mode )
+            out_list, xmer_lists = distance_cache.load_distances( options.cache_dir, key, num_seqs )
+            if xmer_lists is not None:
+                ymer_dict = dict( zip( sequences, xmer_lists ) )
+            record[ 'hit' ] = out_list is not None
+
+    # Until it is returned, the scratch file is removed here if the distances are not all computed
+    try:
+        if out_list is None:
+            if options.scratch_dir is not None:
+                file_handle, scratch_file = tempfile.mkstemp( prefix = 'distances_', suffix = '.dat', dir = options.scratch_dir )
+                os.close( file_handle )
+                out_list = oligo.create_distance_vector_file( scratch_file, num_seqs, options.distance_dtype )
+
+            if options.approximate:
+                # Sketches replace the exact xmer sets, which are never all held at once
+                ymer_dict = None
+                with profiler.stage( 'distances', num_pairs ):
+                    out_list = oligo.approximate_condensed_distance_vector( sequences, options.XmerWindowSize, 1,
+                                                                            options.sketch_size, options.bands,
+                                                                            out_list = out_list, dtype = options.distance_dtype,
+                                                                            num_threads = options.threads
+                                                                          )
+            else:
+                ymer_dict = extract_xmers( options, sequences, profiler, sequence_codes )
+
+                with profiler.stage( 'xmer_index', num_seqs ):
+                    xmer_index = oligo.XmerIndex( sequences, options.XmerWindowSize, 1, ymer_dict )
+
+                with profiler.stage( 'distances', num_pairs ):
+                    out_list = oligo.create_condensed_distance_vector( sequences, options.XmerWindowSize, 1, ymer_dict,
+                                                                       options.threads, xmer_index, out_list,
+                                                                       options.distance_dtype
+                                                                     )
+
+            if options.cache_dir is not None:
+                with profiler.stage( 'cache_store' ):
+                    xmer_lists = None
+                    if options.cache_xmers and options.encode and not options.approximate:
+                        xmer_lists = [ ymer_dict[ sequence ] for sequence in sequences ]
+                    distance_cache.store_distances( options.cache_dir, key, out_list, num_seqs,
+                                                    options.cache_size * 1024 * 1024, xmer_lists
+                                                  )
+
+        # Distances loaded from the cache are checked the same way as ones just estimated
+        if options.approximate and options.approx_sample > 0:
+            report = oligo.approximate_distance_error( sequences, out_list, options.XmerWindowSize, 1,
+                                                       options.approx_sample
+                                                     )
+            print( "Approximate distances compared with exact distances for %d pairs:" % report[ 'pairs' ] )
+            print( "Mean absolute error: %.2f" % report[ 'mean_error' ] )
+            print( "Maximum absolute error: %.2f" % report[ 'max_error' ] )
+            print( "Pairs sharing xmers that were not found: %d" % report[ 'missed' ] )
+    except BaseException:
+        remove_scratch_file( scratch_file )
+        raise
+
+    return out_list, ymer_dict, scratch_file
+
+def display_cluster_information( cluster, names, sequences, list_of_distances, window_size, step_size, ymer_dict = None,
+                                 stats_output = None, species_table = None ):
+    """
+        Prints statistics of the clusters, and optionally writes per-cluster statistics to
+        stats_output, as JSON if its name ends in .json and as tab-delimited text otherwise.
+        Distances are read out of list_of_distances, the condensed vector the clustering was
+        made from, and are only computed again when there is none. Sequences are grouped
+        into species by the taxids of their names, and with species_table, by the species
+        of those taxids.
+    """
+    stats = oligo.cluster_distance_statistics( cluster, list_of_distances, sequences, window_size, step_size, ymer_dict )
+
+    taxids = oligo.taxid_array( names )
+    species = taxonomy.species_groups( taxids, species_table )
+    species_stats = oligo.cluster_species_metrics( cluster, species )
+    species_counts = species_stats[ 'species' ]
+    num_species = len( species_stats[ 'species_ids' ] )
+
+    num_clusters = len( stats[ 'cluster' ] )
+    sizes = stats[ 'size' ]
+    cluster_pairs = stats[ 'pairs' ].sum()
+
+    if cluster_pairs > 0:
+        min_distance = np.nanmin( stats[ 'min' ] )
+        max_distance = np.nanmax( stats[ 'max' ] )
+        avg_distance = stats[ 'total' ].sum() / cluster_pairs
+    else:
+        min_distance = max_distance = avg_distance = 0.0
+
+    avg_species_per_cluster = species_counts.sum() / num_clusters
     avg_cluster_per_species = num_clusters / num_species
-    
+
     print( "\nNumber of clusters: %d." % num_clusters )
-    print( "Minimum Cluster Size: %.2f." % min_cluster_size )
-    print( "Maximum Cluster Size: %.2f." % max_cluster_size )
-    print( "Average Cluster Size: %.2f.\n" % avg_cluster_size )
+    print( "Minimum Cluster Size: %.2f." % sizes.min() )
+    print( "Maximum Cluster Size: %.2f." % sizes.max() )
+    print( "Average Cluster Size: %.2f.\n" % sizes.mean() )
 
     print( "Minimum distance between any two sequences within the clusters: %.2f" % min_distance )
     print( "Average distance between any two sequences within the clusters: %.2f" % avg_distance )
@@ -145,8 +747,48 @@ def display_cluster_information( cluster_dict, list_of_distances, window_size, s
     print( "Number of species found in file: %d" % num_species )
     print( "Average species per cluster: %.2f" % avg_species_per_cluster )
     print( "Average clusters per species: %.2f" % avg_cluster_per_species )
-
-    
+    print( "Maximum clusters per species: %d" % species_stats[ 'spread' ].max() )
+    print( "Average species purity of clusters: %.2f" % species_stats[ 'purity' ].mean() )
+
+    if stats_output is not None:
+        # Each species is named after the taxid of its first sequence
+        first_members = np.unique( species, return_index = True )[ 1 ]
+        dominant_species = [ taxonomy.species_label( taxid, species_table )
+                             for taxid in taxids[ first_members[ species_stats[ 'dominant' ] ] ]
+                           ]
+        write_cluster_statistics( stats, species_stats, dominant_species, stats_output )
+
+def write_cluster_statistics( stats, species_stats, dominant_species, file_name ):
+    """
+        Writes one row of statistics per cluster to file_name, as JSON if its name ends
+        in .json and as tab-delimited text otherwise. Distances of single-member clusters,
+        and dominant species of clusters of unknown species, are written as null or NA.
+    """
+    columns = [ 'cluster', 'size', 'pairs', 'min', 'mean', 'max' ]
+    rows = list()
+    for index in range( len( stats[ 'cluster' ] ) ):
+        row = { column: stats[ column ][ index ].item() for column in columns }
+        row[ 'species' ] = int( species_stats[ 'species' ][ index ] )
+        row[ 'purity' ] = species_stats[ 'purity' ][ index ].item()
+        row[ 'dominant_species' ] = dominant_species[ index ]
+        for column in ( 'min', 'mean', 'max' ):
+            if np.isnan( row[ column ] ):
+                row[ column ] = None
+        rows.append( row )
+
+    out_file = open( file_name, 'w' )
+    if file_name.endswith( '.json' ):
+        json.dump( rows, out_file, indent = 1 )
+    else:
+        columns.extend( [ 'species', 'purity', 'dominant_species' ] )
+        out_file.write( "\t".join( columns ) + "\n" )
+        for row in rows:
+            out_file.write( "\t".join( "NA" if row[ column ] is None else
+                                        ( "%.2f" % row[ column ] if isinstance( row[ column ], float ) else str( row[ column ] ) )
+                                        for column in columns
+                                      ) + "\n"
+                          )
+    out_file.close()
 
 def add_program_options( options ):
     options.add_option( '-q', '--query', help = "Fasta query file to perform calculations on. [None, required]" )
@@ -160,9 +802,145 @@ def add_program_options( options ):
     options.add_option( '-x', '--XmerWindowSize', help = "Size of xmers to grab from each sequence to do the comparisons [19]", type = int,
                         default = 19 )
 
-    options.add_option( '-v', help = "Display statistical output of clusters, disabled by default because this is very slow. [False]",
+    options.add_option( '-t', '--threads', help = "Number of processes to use when computing the distance matrix. [1]",
+                        default = 1, type = int
+                      )
+
+    options.add_option( '--encode', help = "Store each sequence's xmers as a sorted array of packed integers instead of a set of strings, "
+                                           "using far less memory. Sequences may only contain uppercase letters, '-', '*', "
+                                           "and '.'. [False]",
+                        action = 'store_true', default = False
+                      )
+
+    options.add_option( '--approximate', help = "Estimate distances from MinHash sketches, only comparing pairs found by LSH. [False]",
+                        action = 'store_true', default = False
+                      )
+    options.add_option( '--sketch_size', help = "Number of hash functions in each MinHash sketch, used with --approximate. [128]",
+                        default = 128, type = int
+                      )
+    options.add_option( '--bands', help = "Number of LSH bands to split each sketch into, must divide --sketch_size. [64]",
+                        default = 64, type = int
+                      )
+    options.add_option( '--approx_sample', help = "Number of pairs to check against exact distances with --approximate, 0 to skip. [1000]",
+                        default = 1000, type = int
+                      )
+
+    options.add_option( '--cache_dir', help = "Directory to cache distance matrices in, so later runs on the same input "
+                                              "skip straight to clustering. [None, no caching]"
+                      )
+    options.add_option( '--cache_size', help = "Maximum size of the cache directory in megabytes, the least recently used "
+                                               "entries are removed past it. [10240]",
+                        default = 10240, type = int
+                      )
+    options.add_option( '--cache_xmers', help = "Also cache the xmers of each sequence, only with --encode. [False]",
+                        action = 'store_true', default = False
+                      )
+
+    options.add_option( '--scratch_dir', help = "Directory to keep the distance matrix in as a memory mapped file, "
+                                                "instead of in memory. [None]"
+                      )
+    options.add_option( '--distance_dtype', help = "How to store each distance, one of float64, float32, or uint8, "
+                                                   "which rounds distances to 1/255 of their range. [float64]",
+                        type = 'choice', choices = [ 'float64', 'float32', 'uint8' ], default = 'float64'
+                      )
+
+    options.add_option( '--greedy', help = "Cluster greedily instead of hierarchically, from the longest sequence down, each "
+                                           "sequence joining the first representative within --distance_threshold of it or "
+                                           "becoming a new representative. [False]", action = 'store_true', default = False
+                      )
+    options.add_option( '--representatives', help = "With --greedy, write the representative of each cluster to this fasta file. [None]" )
+
+    options.add_option( '--distance_output', help = "Write the condensed distance vector to this .npy file, which can be memory mapped, "
+                                                    "with the order of its sequences beside it in a file ending in _order.txt. [None]"
+                      )
+    options.add_option( '--edge_output', help = "Write the pairs at most --edge_max_distance apart to this file, as a scipy.sparse "
+                                                "COO matrix if it ends in .npz, with the order of its sequences beside it in a file "
+                                                "ending in _order.txt, or otherwise as tab-delimited lines of both names and "
+                                                "their distance. [None]"
+                      )
+    options.add_option( '--edge_max_distance', help = "Maximum distance of the pairs written with --edge_output. [pairs sharing xmers]",
+                        type = float
+                      )
+
+    options.add_option( '--graph', help = "Cluster from a graph of only the pairs that share xmers, using its minimum spanning tree, "
+                                          "instead of the full distance matrix. Gives the same clusters. [False]",
+                        action = 'store_true', default = False
+                      )
+    options.add_option( '--distance_threshold', help = "Cut the clustering at this distance instead of into at most "
+                                                       "--clusters clusters. [None]",
+                        type = float
+                      )
+
+    options.add_option( '--save_state', help = "Directory to save the run in, its xmer index and linkage, so that "
+                                               "sequences can later be added to it with --append. [None]"
+                      )
+    options.add_option( '--append', help = "Directory of a run saved with --save_state to add the sequences of -q to. Only "
+                                           "the distances of the new sequences are computed, the run is updated, "
+                                           "and every sequence of it is written to the output. [None]"
+                      )
+
+    options.add_option( '--build_reference', help = "Instead of clustering, index the sequences of -q and save the index to this "
+                                                    "directory, for finding nearest neighbors with --reference. [None]"
+                      )
+    options.add_option( '--reference', help = "Instead of clustering, find the references of this directory, from --build_reference, "
+                                              "nearest to each sequence of -q. The output holds a tab-delimited line per query "
+                                              "and reference found, of their names and distance. [None]"
+                      )
+    options.add_option( '--top_k', help = "Maximum number of references to find per query with --reference. [10]", default = 10,
+                        type = int
+                      )
+    options.add_option( '--max_distance', help = "Only find references at most this distance from a query with --reference. [None]",
+                        type = float
+                      )
+    options.add_option( '--query_batch', help = "Number of queries each process compares at once with --reference. [1000]",
+                        default = 1000, type = int
+                      )
+
+    options.add_option( '--shard', help = "Only compute shard i/N of the distances, e.g. 2/8, and write it to --shard_dir. "
+                                          "Shards split the distance matrix by the cost of its rows, and are computed "
+                                          "independently, on other machines or in other processes, from the same -q and "
+                                          "options. [None]"
+                      )
+    options.add_option( '--merge', help = "Cluster the shards of --shard_dir, once every shard has been computed, instead "
+                                          "of computing distances. [False]", action = 'store_true', default = False
+                      )
+    options.add_option( '--shard_dir', help = "Directory shards are written to and merged from. [shards]", default = 'shards' )
+
+    options.add_option( '--sweep_windows', help = "Comma-separated window sizes to cluster with in one run, instead of -x. Each line of the output "
+                                                  "then holds a sequence name and its cluster for every window size and "
+                                                  "count of --sweep_clusters, in tab-delimited columns named like x19_c4. [None]"
+                      )
+    options.add_option( '--sweep_clusters', help = "Comma-separated maximum numbers of clusters to cut each window size's clustering into "
+                                                   "with --sweep_windows. [-c]"
+                      )
+
+    options.add_option( '--profile', help = "Write wall time, CPU time, peak memory and throughput of each stage to this JSON file, "
+                                            "and print progress of the distance computation. [None]"
+                      )
+    options.add_option( '--progress_interval', help = "Seconds between progress lines with --profile. [10]",
+                        default = 10.0, type = float
+                      )
+
+    options.add_option( '--min_length', help = "Only cluster sequences with no 'X' and a run of at least this many characters "
+                                               "between gaps. [None]", type = int
+                      )
+    options.add_option( '--percent_valid', help = "Only cluster sequences with no 'X' and less than 100 minus this percent of gaps, "
+                                                  "when --min_length is not set. [None]", type = float
+                      )
+    options.add_option( '--dendrogram', help = "Plot the dendrogram of the clustering to this image file, needs matplotlib. [None]" )
+
+    options.add_option( '-v', help = "Display statistical output of clusters. [False]",
                         action = 'store_true', dest = 'verbose'
                       )  
+    options.add_option( '--species_table', help = "With -v, directory of a species table built by --species_file, to group "
+                                                  "sequences by the species of their taxids instead of by taxid. [None]"
+                      )
+    options.add_option( '--species_file', help = "File of taxid|species lines to compile into the --species_table directory, "
+                                                 "which later runs can then use without this option. [None]"
+                      )
+    options.add_option( '--stats_output', help = "With -v, also write per-cluster distance and species statistics to this file, "
+                                                 "as JSON if it ends in .json and tab-delimited otherwise. [None]"
+                      )
     
 if __name__ == '__main__':
     main()
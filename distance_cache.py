@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+def file_content_hash( file_name, chunk_size = 1 << 20 ):
+    """
+        Computes the sha256 hex digest of the contents of file_name
+    """
+    digest = hashlib.sha256()
+    with open( file_name, 'rb' ) as file_in:
+        for chunk in iter( lambda: file_in.read( chunk_size ), b'' ):
+            digest.update( chunk )
+    return digest.hexdigest()
+
+def cache_key( file_name, window_size, step_size, mode = 'exact' ):
+    """
+        Creates the key of the cache entry for the distances of a fasta file. Any change to
+        the file's contents, window_size, step_size or the distance mode gives a new key.
+
+        :param file_name: string name of the fasta file the distances are computed from
+        :param window_size: integer window_size used to capture xmers
+        :param step_size: integer step_size used to capture xmers
+        :param mode: string describing how distances were computed, e.g. exact or approximate
+                     along with its parameters
+
+        :returns: string key, usable as a directory name
+    """
+    key_data = "%d|%s|%d|%d|%s" % ( CACHE_VERSION, file_content_hash( file_name ), window_size, step_size, mode )
+    return hashlib.sha256( key_data.encode() ).hexdigest()
+
+def load_distances( cache_dir, key, num_items ):
+    """
+        Loads a cached condensed distance vector, memory mapped read-only, along with the
+        xmers of each sequence if they were stored. Entries whose metadata does not match
+        are treated as missing and removed.
+
+        :param cache_dir: string cache directory
+        :param key: string key from cache_key
+        :param num_items: integer number of sequences the distances should be for
+
+        :returns: condensed distance vector, or None if there is no valid entry, and
+                  list of the encoded xmers of each sequence, or None if none were stored
+    """
+    entry = os.path.join( cache_dir, key )
+    meta_file = os.path.join( entry, 'meta.json' )
+    if not os.path.isfile( meta_file ):
+        return None, None
+
+    try:
+        with open( meta_file, 'r' ) as open_file:
+            meta = json.load( open_file )
+        out_list = np.load( os.path.join( entry, 'distances.npy' ), mmap_mode = 'r' )
+    except ( OSError, ValueError ):
+        shutil.rmtree( entry, ignore_errors = True )
+        return None, None
+
+    if meta.get( 'version' ) != CACHE_VERSION or meta.get( 'num_items' ) != num_items or \
+       len( out_list ) != ( num_items * ( num_items - 1 ) ) // 2:
+        del out_list
+        shutil.rmtree( entry, ignore_errors = True )
+        return None, None
+
+    xmer_lists = None
+    if meta.get( 'xmers' ):
+        xmers = np.load( os.path.join( entry, 'xmers.npy' ), mmap_mode = 'r' )
+        offsets = np.load( os.path.join( entry, 'xmer_offsets.npy' ) )
+        xmer_lists = [ xmers[ offsets[ index ] : offsets[ index + 1 ] ] for index in range( num_items ) ]
+
+    # Mark the entry as most recently used
+    os.utime( entry )
+    return out_list, xmer_lists
+
+def store_distances( cache_dir, key, out_list, num_items, max_bytes, xmer_lists = None ):
+    """
+        Stores a condensed distance vector in the cache, then evicts the least recently
+        used entries until the cache is no larger than max_bytes
+
+        :param cache_dir: string cache directory, created if it does not exist
+        :param key: string key from cache_key
+        :param out_list: numpy condensed distance vector to store
+        :param num_items: integer number of sequences the distances are for
+        :param max_bytes: integer maximum size of the cache in bytes
+        :param xmer_lists: optional list of the encoded xmer arrays of each sequence, in order
+    """
+    os.makedirs( cache_dir, exist_ok = True )
+
+    # Written to a temporary directory first, so that readers never see a partial entry
+    temp_entry = tempfile.mkdtemp( prefix = '.tmp', dir = cache_dir )
+    np.save( os.path.join( temp_entry, 'distances.npy' ), np.asarray( out_list ) )
+
+    if xmer_lists is not None:
+        offsets = np.zeros( len( xmer_lists ) + 1, dtype = np.int64 )
+        np.cumsum( [ len( xmers ) for xmers in xmer_lists ], out = offsets[ 1: ] )
+        np.save( os.path.join( temp_entry, 'xmers.npy' ), np.concatenate( xmer_lists ) )
+        np.save( os.path.join( temp_entry, 'xmer_offsets.npy' ), offsets )
+
+    with open( os.path.join( temp_entry, 'meta.json' ), 'w' ) as open_file:
+        json.dump( { 'version': CACHE_VERSION, 'num_items': num_items, 'xmers': xmer_lists is not None }, open_file )
+
+    entry = os.path.join( cache_dir, key )
+    shutil.rmtree( entry, ignore_errors = True )
+    os.rename( temp_entry, entry )
+
+    evict( cache_dir, max_bytes, keep = key )
+
+def entry_size( entry ):
+    return sum( os.path.getsize( os.path.join( entry, file_name ) ) for file_name in os.listdir( entry ) )
+
+def evict( cache_dir, max_bytes, keep = None ):
+    """
+        Removes the least recently used entries of cache_dir until its total size is
+        at most max_bytes. The entry named keep is never removed.
+    """
+    entries = list()
+    for name in os.listdir( cache_dir ):
+        entry = os.path.join( cache_dir, name )
+        if os.path.isdir( entry ) and not name.startswith( '.' ):
+            entries.append( ( os.path.getmtime( entry ), entry_size( entry ), name, entry ) )
+
+    total_size = sum( item[ 1 ] for item in entries )
+    for _, size, name, entry in sorted( entries ):
+        if total_size <= max_bytes:
+            break
+        if name == keep:
+            continue
+        shutil.rmtree( entry, ignore_errors = True )
+        total_size -= size
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import numpy as np
+import protein_oligo_library as oligo
+
+# Entries of a distance vector copied to disk at once
+CHUNK_SIZE = 1 << 22
+
+
+def order_file_name( file_name ):
+    """
+        Gets the name of the file the sequence order of a binary distance file is written to,
+        file_name without its extension, followed by _order.txt
+    """
+    return os.path.splitext( file_name )[ 0 ] + '_order.txt'
+
+def write_order( file_name, names ):
+    """
+        Writes the name of each sequence, one per line, in the order of the items of
+        the binary distance file file_name
+    """
+    with open( order_file_name( file_name ), 'w' ) as out_file:
+        for name in names:
+            out_file.write( name + '\n' )
+
+def write_condensed_vector( file_name, out_list, names, chunk_size = CHUNK_SIZE ):
+    """
+        Writes a condensed distance vector to a .npy file, chunk_size entries at a time, so
+        that a vector larger than memory can be written from its memory map. The file can be
+        loaded with numpy.load( file_name, mmap_mode = 'r' ), and is ordered as
+        scipy.spatial.distance.pdist, over the sequences in the order of order_file_name( file_name ).
+        Distances stored as uint8 are written as float32, other dtypes as they are.
+
+        :param file_name: string name of the .npy file to write
+        :param out_list: condensed distance vector
+        :param names: list of the names of the sequences of out_list, in order
+    """
+    dtype = out_list.dtype
+    if dtype == np.uint8:
+        dtype = np.dtype( np.float32 )
+
+    out_vector = np.lib.format.open_memmap( file_name, mode = 'w+', dtype = dtype, shape = ( len( out_list ), ) )
+    for start in range( 0, len( out_list ), chunk_size ):
+        chunk = out_list[ start : start + chunk_size ]
+        if out_list.dtype == np.uint8:
+            chunk = oligo.dequantize_distances( chunk )
+        out_vector[ start : start + chunk_size ] = chunk
+    out_vector.flush()
+    del out_vector
+
+    write_order( file_name, names )
+
+def write_edge_list( file_name, edge_chunks, names ):
+    """
+        Writes the edges of a thresholded distance matrix as they are computed, one chunk at a time.
+        A file name ending in .npz gets a scipy.sparse COO matrix, readable with
+        scipy.sparse.load_npz, of the upper triangle of the matrix over the sequences in the
+        order of order_file_name( file_name ). Any other file gets a tab-delimited line per
+        edge of the names of both sequences and their distance.
+
+        :param file_name: string name of the file to write
+        :param edge_chunks: iterable of numpy arrays first, second, and distances, for instance
+                            from oligo.condensed_edge_chunks or oligo.distance_edge_chunks
+        :param names: list of the names of the sequences, in order
+
+        :returns: integer number of edges written
+    """
+    if not file_name.endswith( '.npz' ):
+        num_edges = 0
+        with open( file_name, 'w' ) as out_file:
+            for first, second, distances in edge_chunks:
+                out_file.writelines( "%s\t%s\t%s\n" % ( names[ first[ index ] ], names[ second[ index ] ], distances[ index ] )
+                                     for index in range( len( first ) )
+                                   )
+                num_edges += len( first )
+        return num_edges
+
+    # Each part of the matrix is spooled to its own file, then copied into the archive
+    temp_dir = tempfile.mkdtemp( dir = os.path.dirname( os.path.abspath( file_name ) ) )
+    part_names = [ os.path.join( temp_dir, part ) for part in ( 'row', 'col', 'data' ) ]
+    part_dtypes = [ np.int64, np.int64, np.float64 ]
+    try:
+        part_files = [ open( part_name, 'wb' ) for part_name in part_names ]
+        num_edges = 0
+        for edges in edge_chunks:
+            for part_file, part, dtype in zip( part_files, edges, part_dtypes ):
+                np.asarray( part, dtype = dtype ).tofile( part_file )
+            num_edges += len( edges[ 0 ] )
+        for part_file in part_files:
+            part_file.close()
+
+        parts = list()
+        for part_name, dtype in zip( part_names, part_dtypes ):
+            if num_edges:
+                parts.append( np.memmap( part_name, dtype = dtype, mode = 'r', shape = ( num_edges, ) ) )
+            else:
+                parts.append( np.empty( 0, dtype = dtype ) )
+
+        np.savez( file_name, row = parts[ 0 ], col = parts[ 1 ], data = parts[ 2 ], format = b'coo',
+                  shape = np.array( ( len( names ), len( names ) ) )
+                )
+        del parts
+    finally:
+        for part_name in part_names:
+            if os.path.exists( part_name ):
+                os.remove( part_name )
+        os.rmdir( temp_dir )
+
+    write_order( file_name, names )
+    return num_edges
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+import json
+import os
+import numpy as np
+import protein_oligo_library as oligo
+
+SHARD_VERSION = 1
+
+
+def parse_shard( shard ):
+    """
+        Parses a shard given as i/N, the i-th of N shards, counting from 1
+
+        :raises ValueError: if shard is not of that form
+
+        :returns: integers i and N
+    """
+    try:
+        shard, num_shards = ( int( part ) for part in shard.split( '/' ) )
+    except ValueError:
+        raise ValueError( "Shard must be given as i/N, e.g. 1/4" )
+    if not 1 <= shard <= num_shards:
+        raise ValueError( "Shard must be between 1/N and N/N" )
+    return shard, num_shards
+
+def shard_file_name( shard_dir, shard, num_shards ):
+    """
+        Gets the name of the files of shard i/N in shard_dir, without their extension
+    """
+    return os.path.join( shard_dir, "shard_%d_of_%d" % ( shard, num_shards ) )
+
+def shard_rows( xmer_index, num_shards ):
+    """
+        Splits the rows of the condensed distance vector of xmer_index into num_shards
+        contiguous ranges of about equal cost, see oligo.row_costs. Only the sequences
+        and their xmers decide the split, so every shard of a run finds the same one.
+
+        :returns: list of num_shards ( start, end ) row ranges
+    """
+    return oligo.split_rows_by_cost( oligo.row_costs( xmer_index ), num_shards )
+
+def compute_shard( shard_dir, shard, num_shards, xmer_index, input_hash, graph = False, max_distance = None,
+                   dtype = np.float64 ):
+    """
+        Computes one shard of the distances of the sequences of xmer_index and writes it to
+        shard_dir, either as its part of the condensed distance vector, or with graph, as the
+        edges of its rows at most max_distance apart
+
+        :param shard_dir: string directory to write the shard to, created if it does not exist
+        :param shard: integer number of the shard, from 1 to num_shards
+        :param num_shards: integer number of shards of the run
+        :param xmer_index: XmerIndex of every sequence, in clustering order
+        :param input_hash: string hash of the input the sequences were read from, to check that
+                           every shard merged was computed from the same input
+        :param graph: boolean, write the edges of the rows instead of their distances
+        :param max_distance: with graph, if provided, only edges at most this distance apart are kept
+        :param dtype: storage dtype of the distances, float64, float32, or uint8
+
+        :returns: dictionary of the shard's meta data, including its 'start' and 'end' rows
+    """
+    os.makedirs( shard_dir, exist_ok = True )
+    start, end = shard_rows( xmer_index, num_shards )[ shard - 1 ]
+    base_name = shard_file_name( shard_dir, shard, num_shards )
+
+    meta = { 'version': SHARD_VERSION, 'shard': shard, 'num_shards': num_shards, 'num_items': len( xmer_index ),
+             'window_size': xmer_index.window_size, 'step_size': xmer_index.step_size, 'input_hash': input_hash,
+             'start': start, 'end': end
+           }
+    if graph:
+        edges = list( oligo.distance_edge_chunks( xmer_index.sequence_list, xmer_index.window_size, xmer_index.step_size,
+                                                  xmer_index = xmer_index, max_distance = max_distance,
+                                                  start = start, end = end
+                                                )
+                    )
+        if edges:
+            first, second, distances = ( np.concatenate( part ) for part in zip( *edges ) )
+        else:
+            first, second, distances = np.empty( 0, dtype = np.int64 ), np.empty( 0, dtype = np.int64 ), np.empty( 0 )
+        np.savez( base_name + '.npz', first = first, second = second, distances = distances )
+        meta.update( kind = 'edges', max_distance = max_distance )
+    else:
+        distances = oligo.condensed_distance_rows( xmer_index, start, end, dtype )
+        np.save( base_name + '.npy', distances )
+        meta.update( kind = 'vector', dtype = distances.dtype.name )
+
+    # The meta data is written last, so a shard without it is incomplete
+    with open( base_name + '.json', 'w' ) as out_file:
+        json.dump( meta, out_file )
+    return meta
+
+def load_shard_metas( shard_dir, num_items, input_hash ):
+    """
+        Finds the shards of a run in shard_dir, and checks that every one of them is there
+        and that all were computed the same way from the same input
+
+        :raises ValueError: if a shard is missing or does not match the others or the input
+
+        :returns: list of the meta data of each shard, in order
+    """
+    if not os.path.isdir( shard_dir ):
+        raise ValueError( "No shards were found in %s" % shard_dir )
+
+    metas = list()
+    for file_name in sorted( os.listdir( shard_dir ) ):
+        if file_name.startswith( 'shard_' ) and file_name.endswith( '.json' ):
+            with open( os.path.join( shard_dir, file_name ), 'r' ) as open_file:
+                metas.append( json.load( open_file ) )
+
+    if not metas:
+        raise ValueError( "No shards were found in %s" % shard_dir )
+
+    first_meta = metas[ 0 ]
+    for meta in metas:
+        for key in ( 'version', 'num_shards', 'num_items', 'window_size', 'step_size', 'input_hash', 'kind',
+                     'dtype', 'max_distance'
+                   ):
+            if meta.get( key ) != first_meta.get( key ):
+                raise ValueError( "Shards %d and %d of %s differ in %s" % ( first_meta[ 'shard' ], meta[ 'shard' ],
+                                                                            shard_dir, key
+                                                                          )
+                                )
+
+    if first_meta[ 'version' ] != SHARD_VERSION:
+        raise ValueError( "The shards of %s were written by an incompatible version" % shard_dir )
+    if first_meta[ 'num_items' ] != num_items or first_meta[ 'input_hash' ] != input_hash:
+        raise ValueError( "The shards of %s were computed from a different input" % shard_dir )
+
+    metas.sort( key = lambda meta: meta[ 'shard' ] )
+    found = [ meta[ 'shard' ] for meta in metas ]
+    missing = sorted( set( range( 1, first_meta[ 'num_shards' ] + 1 ) ) - set( found ) )
+    if missing or len( found ) != len( set( found ) ):
+        raise ValueError( "Shards %s of %d are missing from %s" % ( ", ".join( str( shard ) for shard in missing ),
+                                                                    first_meta[ 'num_shards' ], shard_dir
+                                                                  )
+                        )
+    return metas
+
+def merge_vector( shard_dir, metas, out_list ):
+    """
+        Copies the distances of every shard into the condensed vector out_list, which may be
+        a memory map, one shard at a time
+    """
+    for meta in metas:
+        shard = np.load( shard_file_name( shard_dir, meta[ 'shard' ], meta[ 'num_shards' ] ) + '.npy', mmap_mode = 'r' )
+        offset = oligo.pairs_in_rows( meta[ 'num_items' ], 0, meta[ 'start' ] )
+        out_list[ offset : offset + len( shard ) ] = shard
+        del shard
+
+def merge_edges( shard_dir, metas ):
+    """
+        Concatenates the edges of every shard
+
+        :returns: numpy arrays first, second, and distances
+    """
+    edges = list()
+    for meta in metas:
+        shard = np.load( shard_file_name( shard_dir, meta[ 'shard' ], meta[ 'num_shards' ] ) + '.npz' )
+        edges.append( ( shard[ 'first' ], shard[ 'second' ], shard[ 'distances' ] ) )
+    return tuple( np.concatenate( part ) for part in zip( *edges ) )
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+class StageProfiler:
+    """
+        Records the wall time, CPU time, and peak resident memory of each stage of a run,
+        along with any metrics the stage adds, and prints progress lines with an ETA for
+        long running stages
+    """
+
+    def __init__( self, progress_interval = 10.0, out_stream = sys.stderr ):
+        """
+            :param progress_interval: float minimum number of seconds between progress lines,
+                                      None to never print them
+            :param out_stream: file to print progress lines to
+        """
+        self.stages = list()
+        self.progress_interval = progress_interval
+        self.out_stream = out_stream
+
+        self._current = None
+        self._stage_start = 0.0
+        self._last_progress = 0.0
+
+    @contextmanager
+    def stage( self, name, items = None ):
+        """
+            Context manager timing the stage called name. The yielded dictionary holds the
+            stage's record, and metrics may be added to it. If the number of items processed
+            is known, items_per_second is added from it.
+        """
+        record = { 'stage': name }
+        if items is not None:
+            record[ 'items' ] = items
+
+        self._current = record
+
+        start_times = os.times()
+        start = time.perf_counter()
+        self._stage_start = start
+        self._last_progress = start
+        try:
+            yield record
+        finally:
+            wall_time = time.perf_counter() - start
+            end_times = os.times()
+
+            record[ 'wall_seconds' ] = wall_time
+            # Worker processes count once they have exited and been waited for
+            record[ 'cpu_seconds' ] = sum( end_times[ :4 ] ) - sum( start_times[ :4 ] )
+            record[ 'peak_rss_bytes' ] = peak_rss_bytes()
+            if record.get( 'items' ) is not None and wall_time > 0:
+                record[ 'items_per_second' ] = record[ 'items' ] / wall_time
+
+            self.stages.append( record )
+            self._current = None
+
+    def progress( self, stage, done, total ):
+        """
+            Progress hook, prints how much of the current stage is done and its estimated time
+            remaining, at most once every progress_interval seconds
+        """
+        if self.progress_interval is None or self._current is None:
+            return
+
+        now = time.perf_counter()
+        if now - self._last_progress < self.progress_interval and done < total:
+            return
+        self._last_progress = now
+
+        elapsed = now - self._stage_start
+        if done > 0 and total > 0:
+            eta = elapsed * ( total - done ) / done
+            self.out_stream.write( "%s: %d/%d (%.1f%%), %.1fs elapsed, ETA %.1fs\n" % ( stage, done, total,
+                                                                                        100.0 * done / total,
+                                                                                        elapsed, eta
+                                                                                      )
+                                 )
+            self.out_stream.flush()
+
+    def report( self ):
+        """
+            :returns: dictionary of the records of every stage, in order, and run totals
+        """
+        return { 'stages': self.stages,
+                 'total_wall_seconds': sum( record[ 'wall_seconds' ] for record in self.stages ),
+                 'total_cpu_seconds': sum( record[ 'cpu_seconds' ] for record in self.stages ),
+                 'peak_rss_bytes': peak_rss_bytes()
+               }
+
+    def write_json( self, file_name ):
+        out_file = open( file_name, 'w' )
+        json.dump( self.report(), out_file, indent = 1 )
+        out_file.close()
+
+def peak_rss_bytes():
+    """
+        Peak resident memory of this process so far, in bytes
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
@@ -1,5 +1,99 @@
 #!/usr/bin/env python3
+import bz2
+import gzip
+import mmap
+import multiprocessing
+import re
+import zlib
+import numpy as np
+
+# scipy is imported by the functions that use it, as importing it takes longer than
+# reading and clustering small inputs
    
+def open_fasta( file_name, mode = 'r' ):
+    """
+        Opens a fasta file in text mode, transparently decompressing gzip and bz2 files.
+        When reading, compression is detected from the file's magic bytes, when writing
+        from a .gz or .bz2 extension.
+    """
+    if 'r' in mode:
+        with open( file_name, 'rb' ) as test_file:
+            magic = test_file.read( 3 )
+        if magic[ :2 ] == b'\x1f\x8b':
+            return gzip.open( file_name, 'rt' )
+        if magic == b'BZh':
+            return bz2.open( file_name, 'rt' )
+        return open( file_name, 'r' )
+
+    if file_name.endswith( '.gz' ):
+        return gzip.open( file_name, mode[ 0 ] + 't' )
+    if file_name.endswith( '.bz2' ):
+        return bz2.open( file_name, mode[ 0 ] + 't' )
+    return open( file_name, mode )
+
+def read_fasta( file_to_read, use_mmap = False ):
+    """
+        Lazily reads the records of a fasta file, which may be gzip or bz2 compressed.
+        Lines are stripped of surrounding whitespace, and the lines of a sequence are
+        joined once the whole record has been read.
+
+        :param file_to_read: string name of the fasta file to read
+        :param use_mmap: boolean, parse an uncompressed file from a memory map of it
+                         instead of reading it line by line
+
+        :returns: generator of ( name, sequence ) tuples
+    """
+    if use_mmap:
+        with open( file_to_read, 'rb' ) as file_in:
+            if file_in.read( 3 )[ :2 ] not in ( b'\x1f\x8b', b'BZ' ):
+                yield from _read_fasta_mmap( file_in )
+                return
+
+    name = None
+    sequence_lines = []
+
+    # Closed even if the records are not all read
+    with open_fasta( file_to_read ) as file_in:
+        for line in file_in:
+            line = line.strip()
+            if line and line[ 0 ] == '>':
+                if name is not None:
+                    yield name, ''.join( sequence_lines )
+                name = line[ 1: ]
+                sequence_lines = []
+            else:
+                sequence_lines.append( line )
+
+        if name is not None:
+            yield name, ''.join( sequence_lines )
+
+def _read_fasta_mmap( file_in ):
+    """
+        Helper of read_fasta, yields the ( name, sequence ) records of a memory mapped file
+    """
+    if file_in.seek( 0, 2 ) == 0:
+        return
+
+    with mmap.mmap( file_in.fileno(), 0, access = mmap.ACCESS_READ ) as mapped:
+        # Anything before the first header is not part of a record
+        if mapped[ :1 ] == b'>':
+            record_start = 0
+        else:
+            record_start = mapped.find( b'\n>' )
+            if record_start >= 0:
+                record_start += 1
+
+        while record_start >= 0:
+            record_end = mapped.find( b'\n>', record_start )
+            record = mapped[ record_start : record_end if record_end >= 0 else len( mapped ) ]
+
+            lines = record.split( b'\n' )
+            yield ( lines[ 0 ].strip()[ 1: ].decode(),
+                    b''.join( [ line.strip() for line in lines[ 1: ] ] ).decode()
+                  )
+
+            record_start = record_end + 1 if record_end >= 0 else -1
+
 def read_fasta_lists( file_to_read ):
     """
        Reads a list of fastas from file_to_read
@@ -8,52 +102,62 @@ def read_fasta_lists( file_to_read ):
         names- a list of names of the sequences found in the fasta file
         sequences- a list of the sequences found in the fasta file
     """
-
-    file_in = open( file_to_read, 'r' )
-    count = 0
-
     names = []
     sequences = []
-    current_sequence = ''
 
-    for line in file_in:
-        line = line.strip()
-        if line and line[ 0 ] == '>':
-            count += 1
-            names.append( line[ 1: ] )
-            if count > 1:
-                sequences.append( current_sequence )
-            current_sequence = ''
+    for name, sequence in read_fasta( file_to_read ):
+        names.append( name )
+        sequences.append( sequence )
 
-        else:
-            current_sequence += line
+    return names, sequences
 
-    sequences.append( current_sequence )
-    file_in.close()
+def write_fasta_records( records, output_name = "out.txt", batch_size = 10000 ):
+    """
+        Writes ( name, sequence ) records to a fasta file, which is compressed if output_name
+        ends in .gz or .bz2. Records are formatted and written batch_size at a time.
 
-    return names, sequences
+        :param records: iterable of ( name, sequence ) tuples, may be a generator
+        :param output_name: string name of the file to write
+        :param batch_size: integer number of records to join into each write
+    """
+    out_file = open_fasta( output_name, 'w' )
+    batch = []
+
+    for name, sequence in records:
+        batch.append( '>%s\n%s\n' % ( name, sequence ) )
+        if len( batch ) >= batch_size:
+            out_file.write( ''.join( batch ) )
+            batch = []
+
+    out_file.write( ''.join( batch ) )
+    out_file.close()
  
+def write_fasta_batches( batches, output_name = "out.txt" ):
+    """
+        Writes batches of names and sequences, such as those of tile_sequences, to one
+        fasta file, a batch at a time
+
+        :param batches: iterable of ( names_list, sequence_list ) tuples, may be a generator
+        :param output_name: string name of the file to write
+    """
+    out_file = open_fasta( output_name, 'w' )
+    for names_list, sequence_list in batches:
+        out_file.write( ''.join( '>%s\n%s\n' % record for record in zip( names_list, sequence_list ) ) )
+    out_file.close()
+
 def write_fastas( names_list, sequence_list, output_name="out.txt" ):
     """
         Writes a fasta file from a list of names and sequences to output file provided
 
     """
-    out_file = open( output_name, 'w+' )
-    for index in range( len( names_list ) ):
-        out_file.write( '>' + names_list[ index ] + '\n' + 
-                        sequence_list[ index ] + '\n'
-                      )
-    out_file.close()
+    write_fasta_records( zip( names_list, sequence_list ), output_name )
         
 
 def char_in_string( test_string, character ):
     """
         Checks if a character is found within a given string
     """
-    for index in range( len( test_string ) ):
-        if test_string[ index ] == character:
-            return True
-    return False
+    return character in test_string
 
 def percentage_of_char_in_string( test_string, character ):
     """
@@ -67,11 +171,7 @@ def percentage_of_char_in_string( test_string, character ):
            is character
     """
     length = len( test_string )
-    char_count = 0.0
-
-    for index in range( length ):
-        if test_string[ index ] == character:
-            char_count += 1
+    char_count = float( test_string.count( character ) )
     return ( char_count / length ) * 100
 
 def count_char_in_string( test_string, character ):
@@ -85,13 +185,7 @@ def count_char_in_string( test_string, character ):
             integer value representing the number of character 
                 were found in test_string
     """
-    length = len( test_string )
-    count = 0
-
-    for index in range( length ):
-        if test_string[ index ] == character:
-            count += 1
-    return count
+    return test_string.count( character )
 
 def min_concurrent_chars( test_string, delimeter_char ):
     """
@@ -124,11 +218,7 @@ def remove_char_from_string( test_string, to_remove ):
         Returns:
            test_string, minus any instance of to_remove character
     """
-    output = ""
-    for index in range( len( test_string ) ):
-        if test_string[ index ] != to_remove:
-            output += test_string[ index ]
-    return output
+    return test_string.replace( to_remove, "" )
 
 
 def create_list_of_uniques( names, sequences ):
@@ -166,13 +256,15 @@ def create_valid_sequence_list( names_list, sequence_list, min_length, percent_v
    valid_names = []
    valid_sequences = []
 
-   for sequence in range( len( sequence_list ) ):
+   sequence_buffer, offsets = create_sequence_buffer( sequence_list )
+   valid = valid_sequence_mask( sequence_buffer, offsets, min_length, percent_valid, start, end )
+
+   for sequence in np.flatnonzero( valid ):
       current_sequence = sequence_list[ sequence ][ start : end ]
 
-      if is_valid_sequence( current_sequence, min_length, percent_valid ):
-           valid_names.append( names_list[ sequence ] )
-           current_sequence = remove_char_from_string( current_sequence, '-' )
-           valid_sequences.append( current_sequence[ start : end ] )
+      valid_names.append( names_list[ sequence ] )
+      current_sequence = remove_char_from_string( current_sequence, '-' )
+      valid_sequences.append( current_sequence[ start : end ] )
 
    names_list = append_suffix( valid_names, start, end )
 
@@ -192,6 +284,90 @@ def is_valid_sequence( sequence, min_length, percent_valid ):
    return False
 
          
+def create_sequence_buffer( sequence_list ):
+    """
+        Loads every sequence of sequence_list into one byte buffer, so that all of them can
+        be tested at once by valid_sequence_mask
+
+        :returns: numpy uint8 array of the characters of every sequence, one after another,
+                  and numpy array of len( sequence_list ) + 1 offsets, sequence i being
+                  buffer[ offsets[ i ] : offsets[ i + 1 ] ]
+    """
+    offsets = np.zeros( len( sequence_list ) + 1, dtype = np.int64 )
+    np.cumsum( [ len( sequence ) for sequence in sequence_list ], out = offsets[ 1: ] )
+    sequence_buffer = np.frombuffer( "".join( sequence_list ).encode( 'latin-1' ), dtype = np.uint8 )
+    return sequence_buffer, offsets
+
+def _slice_bounds( lengths, index, default ):
+    # Where index falls in sequences of each length, as it would in a Python slice
+    if index is None:
+        return default
+    if index < 0:
+        return np.maximum( lengths + index, 0 )
+    return np.minimum( index, lengths )
+
+def window_statistics( sequence_buffer, offsets, start = None, end = None, delimeter_char = '-' ):
+    """
+        Computes, in vectorized passes over a buffer from create_sequence_buffer, what
+        is_valid_sequence tests of the window [ start : end ] of every sequence
+
+        :returns: dictionary of numpy arrays with one entry per sequence: 'length' of the window,
+                  'has_x', whether it contains an 'X', 'gaps', the number of delimeter_char in it,
+                  and 'min_run', min_concurrent_chars of it
+    """
+    lengths = np.diff( offsets )
+    window_starts = offsets[ :-1 ] + _slice_bounds( lengths, start, 0 )
+    window_ends = offsets[ :-1 ] + _slice_bounds( lengths, end, lengths )
+    window_ends = np.maximum( window_ends, window_starts )
+
+    x_positions = np.flatnonzero( sequence_buffer == ord( 'X' ) )
+    has_x = np.searchsorted( x_positions, window_ends ) > np.searchsorted( x_positions, window_starts )
+
+    gap_positions = np.flatnonzero( sequence_buffer == ord( delimeter_char ) )
+    first_gaps = np.searchsorted( gap_positions, window_starts )
+    gaps = np.searchsorted( gap_positions, window_ends ) - first_gaps
+
+    # The run before the first gap counts even if it is empty, as in min_concurrent_chars
+    min_run = window_ends - window_starts
+    has_gap = gaps > 0
+    min_run[ has_gap ] = gap_positions[ first_gaps[ has_gap ] ] - window_starts[ has_gap ]
+
+    # Every later run ends at the next gap, or at the end of its window, and counts if it is not empty
+    window_of_gap = np.searchsorted( window_starts, gap_positions, side = 'right' ) - 1
+    in_window = window_of_gap >= 0
+    in_window[ in_window ] = gap_positions[ in_window ] < window_ends[ window_of_gap[ in_window ] ]
+    run_gaps = gap_positions[ in_window ]
+    run_windows = window_of_gap[ in_window ]
+
+    run_ends = np.minimum( np.append( run_gaps[ 1: ], np.iinfo( np.int64 ).max ), window_ends[ run_windows ] )
+    runs = run_ends - run_gaps - 1
+    not_empty = runs > 0
+    np.minimum.at( min_run, run_windows[ not_empty ], runs[ not_empty ] )
+
+    return { 'length': window_ends - window_starts, 'has_x': has_x, 'gaps': gaps, 'min_run': min_run }
+
+def valid_sequence_mask( sequence_buffer, offsets, min_length, percent_valid, start = None, end = None ):
+    """
+        Vectorized is_valid_sequence of the window [ start : end ] of every sequence of a buffer
+        from create_sequence_buffer. The buffer can be reused for any number of windows.
+
+        :raises ZeroDivisionError: if percent_valid is used and some window without an 'X'
+                                   is empty, exactly as is_valid_sequence does
+
+        :returns: numpy boolean array, True for each sequence whose window is valid
+    """
+    statistics = window_statistics( sequence_buffer, offsets, start, end )
+
+    if min_length is not None:
+        return ~statistics[ 'has_x' ] & ( statistics[ 'min_run' ] >= min_length )
+
+    if np.any( ( statistics[ 'length' ] == 0 ) & ~statistics[ 'has_x' ] ):
+        raise ZeroDivisionError( "float division by zero" )
+
+    with np.errstate( invalid = 'ignore', divide = 'ignore' ):
+        gap_percent = ( statistics[ 'gaps' ].astype( np.float64 ) / statistics[ 'length' ] ) * 100
+    return ~statistics[ 'has_x' ] & ( gap_percent < ( 100 - percent_valid ) )
+
 def append_suffix( string, start, end ):
    """
        Appends _start_end to a string
@@ -216,36 +392,197 @@ def subset_lists_iter( sequence, window_size, step_size ):
 
     return xmer_set
 
+# Every character gets a nonzero 5-bit code, 0 pads xmers that do not fill their last word
+XMER_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ-*.'
+XMER_BITS = 5
+XMERS_PER_WORD = 12
+
+_xmer_codes = np.zeros( 256, dtype = np.uint64 )
+for _code, _character in enumerate( XMER_ALPHABET ):
+    _xmer_codes[ ord( _character ) ] = _code + 1
+
+def xmer_dtype( xmer_length ):
+    """
+        Gets the numpy dtype of a packed xmer of up to xmer_length characters, a single
+        uint64 for up to XMERS_PER_WORD characters, otherwise a record of uint64 words
+    """
+    num_words = -( -xmer_length // XMERS_PER_WORD )
+    if num_words <= 1:
+        return np.dtype( np.uint64 )
+    return np.dtype( [ ( 'w%d' % word, np.uint64 ) for word in range( num_words ) ] )
+
+def encode_sequence( sequence ):
+    """
+        Gets the XMER_BITS code of each character of sequence, which encode_xmers packs
+        into xmers of any window size. XMER_BITS bits cannot also tell lowercase
+        characters apart, so, like any other character outside of XMER_ALPHABET,
+        they are not encoded rather than folded into uppercase ones.
+
+        :raises ValueError: if sequence contains a character outside of XMER_ALPHABET
+
+        :returns: numpy uint64 array of the code of each character of sequence
+    """
+    codes = _xmer_codes[ np.frombuffer( sequence.encode( 'latin-1' ), dtype = np.uint8 ) ]
+    if not np.all( codes ):
+        raise ValueError( "Sequence contains a character that cannot be encoded as an xmer, only %s are" % XMER_ALPHABET )
+    return codes
+
+def encode_xmers( sequence, window_size, step_size, codes = None ):
+    """
+        Packed integer equivalent of subset_lists_iter. Each character of an xmer is
+        packed into XMER_BITS bits of a uint64 word, XMERS_PER_WORD characters per word,
+        with the xmers of every window computed at once over a strided view of the sequence.
+        Windows containing an 'X' are skipped, as in subset_lists_iter.
+
+        :param sequence: string sequence to take the xmers of
+        :param window_size: integer window_size to capture at a time from the sequence
+        :param step_size: integer step_size, with the window semantics of subset_lists_iter
+        :param codes: optional result of encode_sequence( sequence ), to reuse it across window sizes
+
+        :raises ValueError: if sequence contains a character outside of XMER_ALPHABET
+
+        :returns: sorted numpy array of the distinct packed xmers of sequence, of dtype
+                  xmer_dtype( window_size + step_size - 1 )
+    """
+    if codes is None:
+        codes = encode_sequence( sequence )
+
+    xmer_length = window_size + step_size - 1
+    num_words = -( -xmer_length // XMERS_PER_WORD )
+    out_dtype = xmer_dtype( xmer_length )
+    if window_size > len( sequence ):
+        return np.empty( 0, dtype = out_dtype )
+
+    # subset_lists_iter takes window_size characters at 0, then longer windows every step_size
+    windows = [ codes[ np.newaxis, :window_size ] ]
+    if step_size > 0 and xmer_length <= len( sequence ):
+        windows.append( np.lib.stride_tricks.sliding_window_view( codes, xmer_length )[ step_size::step_size ] )
+
+    shifts = XMER_BITS * np.arange( XMERS_PER_WORD, dtype = np.uint64 )
+    words = list()
+    keep = list()
+    for window in windows:
+        padded = np.zeros( ( window.shape[ 0 ], num_words * XMERS_PER_WORD ), dtype = np.uint64 )
+        padded[ :, :window.shape[ 1 ] ] = window
+        words.append( ( padded.reshape( window.shape[ 0 ], num_words, XMERS_PER_WORD ) << shifts ).sum( axis = 2 ) )
+        keep.append( ~np.any( window == _xmer_codes[ ord( 'X' ) ], axis = 1 ) )
+
+    words = np.concatenate( words )[ np.concatenate( keep ) ]
+    if out_dtype.names is None:
+        return np.unique( words[ :, 0 ] )
+    return np.unique( np.ascontiguousarray( words ).view( out_dtype ).ravel() )
+
+def count_shared_xmers( first_seq_ymers, second_seq_ymers ):
+    """
+        Counts the xmers two sequences have in common, either as Python sets or
+        as sorted arrays from encode_xmers, which are merged instead of hashed
+    """
+    if isinstance( first_seq_ymers, np.ndarray ):
+        return len( np.intersect1d( first_seq_ymers, second_seq_ymers, assume_unique = True ) )
+    return len( first_seq_ymers & second_seq_ymers )
+
+def create_ymer_dict( sequence_list, window_size, step_size, encode = False, sequence_codes = None ):
+    """
+        Creates the dictionary of sequence: xmers used throughout this module, with the xmers
+        of each sequence from subset_lists_iter, or from encode_xmers if encode is True.
+        With encode, sequence_codes may be a dictionary of sequence: encode_sequence( sequence ),
+        shared between calls for different window sizes.
+    """
+    ymer_dict = {}
+    for current_sequence in sequence_list:
+        if encode:
+            codes = None
+            if sequence_codes is not None:
+                codes = sequence_codes[ current_sequence ]
+            ymer_dict[ current_sequence ] = encode_xmers( current_sequence, window_size, step_size, codes )
+        else:
+            ymer_dict[ current_sequence ] = subset_lists_iter( current_sequence, window_size, step_size )
+    return ymer_dict
+
 def subset_lists( name, sequence, window_size, step_size ):
    """
        Creates a list of subsets of windowSize size in intervals of stepSize
-       Note: Uses recursive subset_lists_helper for operations
-   
+       Note: Uses tile_sequences for operations
+
        Params:
             name: String name of sequence to be split up
             sequence: String sequence to be split up into a list
        Returns:
-            a list of the split up names, with a suffix applied, and a list of the segments 
+            a list of the split up names, with a suffix applied, and a list of the segments
             of the list, as specified
    """
    new_names = []
    new_seqs = []
-   return subset_lists_helper( name, sequence, new_names, new_seqs, window_size, step_size, 0, window_size )
+   for names, oligos in tile_sequences( [ name ], [ sequence ], window_size, step_size ):
+       new_names.extend( names )
+       new_seqs.extend( oligos )
+   return new_names, new_seqs
 
-def subset_lists_helper( name, sequence, name_arr, seq_arr, window_size, step_size, start, end ):
-    """
-        Recursive helper method called by subset_lists
+def tile_counts( lengths, window_size, step_size ):
     """
-    if start + window_size < len( sequence ):
-       if len( sequence[ start: end ] ) == 1:
-           return
-       seq_arr.append( sequence[ start : end ] ) 
-       name_arr.append( append_suffix( name, start + 1, end ) )
+        Counts the tiles of sequences of each length. Tiles start every step_size characters
+        from the start of a sequence, and only tiles that end before the last character of
+        the sequence are taken. Windows of a single character are not tiles.
 
-       subset_lists_helper( name, sequence, name_arr, seq_arr, window_size, step_size, start + step_size, start + step_size + window_size )
-    return name_arr, seq_arr
-   
+        :param lengths: numpy array of sequence lengths
+        :returns: numpy int64 array of the number of tiles of each length
+    """
+    if window_size <= 1:
+        return np.zeros( len( lengths ), dtype = np.int64 )
+    return np.maximum( ( np.asarray( lengths, dtype = np.int64 ) - window_size + step_size - 1 ) // step_size, 0 )
 
+def tile_sequences( names_list, sequence_list, window_size, step_size, batch_size = 100000 ):
+    """
+        Tiles every sequence of sequence_list into oligos of window_size characters every
+        step_size characters, as subset_lists does for one sequence, naming each oligo
+        name_start_end with 1-based inclusive positions. Sequences are tiled together, a
+        group of them at a time, by taking the tiles as strided views of one byte buffer,
+        so that whole proteomes can be tiled without a Python call per tile.
+
+        :param names_list: list of the names of the sequences
+        :param sequence_list: list of string sequences to tile
+        :param window_size: integer number of characters of each oligo
+        :param step_size: integer number of characters between the starts of oligos
+        :param batch_size: integer number of tiles in each batch yielded
+
+        :returns: generator of lists of the names and oligos of batch_size tiles, in sequence
+                  order, ready for write_fastas or write_fasta_batches
+    """
+    counts = tile_counts( [ len( sequence ) for sequence in sequence_list ], window_size, step_size )
+    tile_ends = np.cumsum( counts )
+
+    first = 0
+    while first < len( sequence_list ):
+        # Sequences whose tiles fill a batch are tiled together
+        last = max( int( np.searchsorted( tile_ends, tile_ends[ first ] - counts[ first ] + batch_size, side = 'left' ) ),
+                    first
+                  ) + 1
+        last = min( last, len( sequence_list ) )
+
+        names, oligos = _tile_group( names_list[ first : last ], sequence_list[ first : last ], counts[ first : last ],
+                                     window_size, step_size
+                                   )
+        for start in range( 0, len( oligos ), batch_size ):
+            yield names[ start : start + batch_size ], oligos[ start : start + batch_size ]
+        first = last
+
+def _tile_group( names_list, sequence_list, counts, window_size, step_size ):
+    num_tiles = int( counts.sum() )
+    if num_tiles == 0:
+        return [], []
+
+    sequence_buffer, offsets = create_sequence_buffer( sequence_list )
+    sequence_index = np.repeat( np.arange( len( sequence_list ) ), counts )
+    tile_starts = ( np.arange( num_tiles ) - np.repeat( np.cumsum( counts ) - counts, counts ) ) * step_size
+
+    windows = np.lib.stride_tricks.sliding_window_view( sequence_buffer, window_size )[ offsets[ sequence_index ] + tile_starts ]
+    # The buffer is latin-1, so each byte is the code point of its character
+    oligos = np.ascontiguousarray( windows, dtype = np.uint32 ).view( 'U%d' % window_size ).ravel()
+
+    names = np.repeat( np.array( names_list, dtype = str ), counts )
+    for part in ( '_', ( tile_starts + 1 ).astype( str ), '_', ( tile_starts + window_size ).astype( str ) ):
+        names = np.char.add( names, part )
+    return names.tolist(), oligos.tolist()
 
 def component_xmer_locs(ymer, xdict, xmer_size, step_size):
     xmer_locs = []
@@ -259,14 +596,15 @@ def get_single_sequence_dist( first_seq_ymers, second_seq_ymers, window_size, st
         Computes the 'distance' between two sequences, where distance is the 
         number of shared xmers / the average of the xmers of both sequences
 
-        :param first_seq_ymers: list of ymers to compare to second_seq_ymers
+        :param first_seq_ymers: list of ymers to compare to second_seq_ymers, may also be
+                                the sorted array of packed xmers from encode_xmers
         :param second_seq_ymers: list of ymers to compare to first_seq_ymers
         :param return_subset_ymers: boolean flag to return the set of a sequence's ymers
        
         :returns: percentage of average ymers shared between between sequence first_seq and sequence second_seq,
                   and also first_seq's subset ymers, if return_subset_ymers is set to true
     """
-    intersection = len( first_seq_ymers & second_seq_ymers )
+    intersection = count_shared_xmers( first_seq_ymers, second_seq_ymers )
     average_length = min( len( first_seq_ymers ), len( second_seq_ymers ) )
 
     if average_length == 0:
@@ -309,7 +647,7 @@ def get_distance_from_other_sequences( in_seq, sequence_list, ymer_dict, window_
 
     return return_difference_list
 
-def create_distance_matrix_of_sequences( sequence_list, window_size, step_size, ymer_dict = None ):
+def create_distance_matrix_of_sequences( sequence_list, window_size, step_size, ymer_dict = None, num_threads = 1 ):
     """
         Create a distance matrix from a list of sequences, where distance is defined as in 
         get_single_sequence_dist
@@ -319,31 +657,1354 @@ def create_distance_matrix_of_sequences( sequence_list, window_size, step_size,
         :param step_size: integer step_size to use in subset_lists
         :param ymer_dict: dictionary of sequence: list of ymers, will be created from sequence_list
                           if none is provided
+        :param num_threads: integer number of worker processes to compute distances with
     
+        :raises ZeroDivisionError: if a sequence has no xmers, as its distance to itself is undefined
 
         :returns: matrix of sequence distances, adjacency matrix of a graph
     """
-    distance_matrix = list()
+    if ymer_dict is None:
+        ymer_dict = create_ymer_dict( sequence_list, window_size, step_size )
+
+    # The diagonal compares each sequence with itself, which get_single_sequence_dist cannot do without xmers
+    if any( len( ymer_dict[ sequence ] ) == 0 for sequence in sequence_list ):
+        raise ZeroDivisionError( "division by zero" )
+
+    condensed = create_condensed_distance_vector( sequence_list, window_size, step_size, ymer_dict, num_threads )
+    return condensed_to_square( condensed, len( sequence_list ) ).tolist()
+
+def create_xmer_sequence_matrix( sequence_list, ymer_dict, xmer_ids = None ):
+    """
+        Creates a sparse sequence x xmer incidence matrix, where entry (i, j) is 1
+        if sequence i contains the xmer that was assigned integer id j
+
+        :param sequence_list: list of string sequences, one row per sequence
+        :param ymer_dict: dictionary of sequence: set of ymers
+        :param xmer_ids: dictionary of xmer: integer id, filled in with any xmer
+                         not already in it
+
+        :returns: scipy.sparse CSR matrix of shape ( len( sequence_list ), number of distinct xmers ),
+                  and numpy array of the number of xmers in each sequence
+    """
+    from scipy import sparse
+
+    if xmer_ids is None:
+        xmer_ids = {}
+    indptr = np.zeros( len( sequence_list ) + 1, dtype = np.int64 )
+    indices = list()
+
+    for current_sequence in range( len( sequence_list ) ):
+        current_ymers = ymer_dict[ sequence_list[ current_sequence ] ]
+        for current_ymer in current_ymers:
+            indices.append( xmer_ids.setdefault( current_ymer, len( xmer_ids ) ) )
+        indptr[ current_sequence + 1 ] = len( indices )
+
+    indices = np.array( indices, dtype = np.int64 )
+    data = np.ones( len( indices ), dtype = np.int32 )
+    xmer_matrix = sparse.csr_matrix( ( data, indices, indptr ),
+                                     shape = ( len( sequence_list ), len( xmer_ids ) )
+                                   )
+    return xmer_matrix, np.diff( indptr )
+
+def create_encoded_xmer_sequence_matrix( sequence_list, ymer_dict ):
+    """
+        Version of create_xmer_sequence_matrix for packed xmers from encode_xmers, whose
+        ids are assigned all at once by sorting every sequence's xmers together
+
+        :returns: scipy.sparse CSR sequence x xmer matrix, numpy array of the number of
+                  xmers in each sequence, and the sorted numpy array of the distinct xmers,
+                  where xmer j of the matrix is entry j
+    """
+    from scipy import sparse
+
+    xmer_arrays = [ ymer_dict[ current_sequence ] for current_sequence in sequence_list ]
+    xmer_counts = np.array( [ len( xmers ) for xmers in xmer_arrays ], dtype = np.int64 )
+
+    indptr = np.zeros( len( sequence_list ) + 1, dtype = np.int64 )
+    np.cumsum( xmer_counts, out = indptr[ 1: ] )
+
+    if xmer_arrays:
+        xmer_codes, indices = np.unique( np.concatenate( xmer_arrays ), return_inverse = True )
+    else:
+        xmer_codes, indices = np.empty( 0, dtype = np.uint64 ), np.empty( 0, dtype = np.int64 )
+
+    xmer_matrix = sparse.csr_matrix( ( np.ones( len( indices ), dtype = np.int32 ), indices.ravel(), indptr ),
+                                     shape = ( len( sequence_list ), len( xmer_codes ) )
+                                   )
+    return xmer_matrix, xmer_counts, xmer_codes
+
+def condensed_index( num_items, first, second ):
+    """
+        Computes the index of the pair ( first, second ), first < second, in a condensed
+        distance vector of num_items items, as laid out by scipy.spatial.distance.pdist
+    """
+    return num_items * first - ( first * ( first + 1 ) ) // 2 + ( second - first - 1 )
+
+def lower_triangle_tiles( start, end ):
+    """
+        Splits the rows start <= k < end of the lower triangle, row k holding the pairs
+        ( i, k ) with i < k, into tiles of at most TILE_PAIRS pairs, or of a single row
+
+        :returns: list of tuples ( tile_start, tile_end )
+    """
+    tiles = list()
+    tile_start = start
+    while tile_start < end:
+        tile_end = tile_start + 1
+        while tile_end < end and ( tile_end * ( tile_end + 1 ) - tile_start * ( tile_start - 1 ) ) // 2 <= TILE_PAIRS:
+            tile_end += 1
+        tiles.append( ( tile_start, tile_end ) )
+        tile_start = tile_end
+    return tiles
+
+def distances_from_counts( intersection, first_sizes, second_sizes ):
+    """
+        Vectorized form of get_single_sequence_dist, computes distances from arrays of
+        shared xmer counts and the number of xmers in each member of the pair
+
+        :raises ZeroDivisionError: if neither sequence of some pair has any xmers,
+                                   exactly as get_single_sequence_dist does
+    """
+    average_length = np.minimum( first_sizes, second_sizes )
+    average_length = np.where( average_length == 0, np.maximum( first_sizes, second_sizes ), average_length )
+
+    if np.any( average_length == 0 ):
+        raise ZeroDivisionError( "division by zero" )
+
+    return 100 - ( ( intersection / average_length ) * 100 )
+
+def check_xmer_counts( xmer_counts ):
+    """
+        Checks the xmer counts of the sequences to be compared, as distances_from_counts
+        cannot compute the distance between two sequences without any xmers
+
+        :param xmer_counts: numpy array of the number of xmers in each sequence
+        :raises ZeroDivisionError: if more than one sequence has no xmers
+    """
+    if np.count_nonzero( xmer_counts == 0 ) > 1:
+        raise ZeroDivisionError( "division by zero" )
+
+def unrelated_distance( dtype ):
+    """
+        :returns: the distance of pairs that share no xmers, 100, as stored in a
+                  distance vector of dtype, see quantize_distances
+    """
+    return quantize_distances( np.array( [ 100.0 ] ), dtype )[ 0 ]
+
+class XmerIndex:
+    """
+        Inverted index from each xmer to the ids of the sequences that contain it,
+        where a sequence's id is its position in sequence_list.
+
+        Shared xmer counts are only ever accumulated along the posting lists of the index,
+        so pairs of sequences that have no xmer in common are never visited.
+    """
+
+    def __init__( self, sequence_list, window_size, step_size, ymer_dict = None ):
+        """
+            :param sequence_list: list of string sequences to index
+            :param window_size: integer window_size to capture at a time from each sequence
+            :param step_size: integer step_size to use in subset_lists
+            :param ymer_dict: dictionary of sequence: set of ymers, will be created from
+                              sequence_list if none is provided
+        """
+        if ymer_dict is None:
+           ymer_dict = {}
+           for current_sequence in sequence_list:
+               ymer_dict[ current_sequence ] = subset_lists_iter( current_sequence, window_size, step_size )
+
+        self.sequence_list = sequence_list
+        self.window_size = window_size
+        self.step_size = step_size
+        self.ymer_dict = ymer_dict
+
+        # String xmers get their ids from xmer_ids, packed xmers are identified by their
+        # position in the sorted xmer_codes
+        self.xmer_ids = {}
+        self.xmer_codes = None
+        if isinstance( next( iter( ymer_dict.values() ), None ), np.ndarray ):
+            self.xmer_matrix, self.xmer_counts, self.xmer_codes = \
+                    create_encoded_xmer_sequence_matrix( sequence_list, ymer_dict )
+        else:
+            self.xmer_matrix, self.xmer_counts = create_xmer_sequence_matrix( sequence_list, ymer_dict, self.xmer_ids )
+
+        # Row j of postings lists the ids of the sequences containing xmer j
+        self.postings = self.xmer_matrix.T.tocsr()
+
+    @classmethod
+    def from_matrix( cls, sequence_list, window_size, step_size, xmer_matrix, xmer_codes = None, xmer_ids = None ):
+        """
+            Recreates an XmerIndex from the xmer_matrix and xmer_codes or xmer_ids of one
+            that was saved, without taking the xmers of sequence_list again
+        """
+        xmer_index = cls.__new__( cls )
+        xmer_index.sequence_list = sequence_list
+        xmer_index.window_size = window_size
+        xmer_index.step_size = step_size
+        xmer_index.ymer_dict = None
+        xmer_index.xmer_ids = xmer_ids if xmer_ids is not None else {}
+        xmer_index.xmer_codes = xmer_codes
+        xmer_index.xmer_matrix = xmer_matrix.tocsr()
+        xmer_index.xmer_counts = np.diff( xmer_index.xmer_matrix.indptr ).astype( np.int64 )
+        xmer_index.postings = xmer_index.xmer_matrix.T.tocsr()
+        return xmer_index
+
+    def append_sequences( self, sequence_list, ymer_dict ):
+        """
+            Adds the sequences of sequence_list to the end of the index, new xmers getting
+            new ids, so that existing sequences keep their ids
+
+            :param sequence_list: list of string sequences to add
+            :param ymer_dict: dictionary of sequence: xmers of at least the sequences in
+                              sequence_list, as sets or as arrays from encode_xmers,
+                              like the xmers already indexed
+        """
+        from scipy import sparse
+
+        old_matrix = self.xmer_matrix
+        if self.xmer_codes is None:
+            new_matrix, new_counts = create_xmer_sequence_matrix( sequence_list, ymer_dict, self.xmer_ids )
+            num_xmers = len( self.xmer_ids )
+        else:
+            new_matrix, new_counts, new_codes = create_encoded_xmer_sequence_matrix( sequence_list, ymer_dict )
+            if new_codes.dtype != self.xmer_codes.dtype:
+                raise ValueError( "Sequences to append were encoded with a different window size" )
+
+            # Packed xmers are identified by position, so both sides are renumbered into the merged codes
+            xmer_codes = np.union1d( self.xmer_codes, new_codes )
+            old_matrix = sparse.csr_matrix( ( old_matrix.data, np.searchsorted( xmer_codes, self.xmer_codes )[ old_matrix.indices ],
+                                              old_matrix.indptr
+                                            ), shape = ( old_matrix.shape[ 0 ], len( xmer_codes ) )
+                                          )
+            new_matrix = sparse.csr_matrix( ( new_matrix.data, np.searchsorted( xmer_codes, new_codes )[ new_matrix.indices ],
+                                              new_matrix.indptr
+                                            ), shape = ( new_matrix.shape[ 0 ], len( xmer_codes ) )
+                                          )
+            self.xmer_codes = xmer_codes
+            num_xmers = len( xmer_codes )
+
+        old_matrix = sparse.csr_matrix( ( old_matrix.data, old_matrix.indices, old_matrix.indptr ),
+                                        shape = ( old_matrix.shape[ 0 ], num_xmers )
+                                      )
+        self.xmer_matrix = sparse.vstack( [ old_matrix, new_matrix ], format = 'csr' )
+        self.xmer_counts = np.concatenate( [ self.xmer_counts, new_counts ] )
+        self.postings = self.xmer_matrix.T.tocsr()
+        self.sequence_list = list( self.sequence_list ) + list( sequence_list )
+        if self.ymer_dict is not None:
+            self.ymer_dict.update( ( sequence, ymer_dict[ sequence ] ) for sequence in sequence_list )
+
+    def query_matrix( self, sequence_list, ymer_dict ):
+        """
+            Creates the sequence x xmer matrix of sequences that are not in the index, over the
+            xmers of the index. Xmers the index does not have are left out of the matrix, but
+            are still counted as xmers of their sequence.
+
+            :param sequence_list: list of string sequences
+            :param ymer_dict: dictionary of sequence: xmers of at least the sequences in
+                              sequence_list, taken like the xmers of the index
+
+            :returns: scipy.sparse CSR matrix of shape ( len( sequence_list ), number of xmers of the index ),
+                      and numpy array of the number of xmers in each sequence
+        """
+        from scipy import sparse
+
+        xmer_counts = np.array( [ len( ymer_dict[ sequence ] ) for sequence in sequence_list ], dtype = np.int64 )
+        if self.xmer_codes is None:
+            indptr = np.zeros( len( sequence_list ) + 1, dtype = np.int64 )
+            indices = list()
+            for current_sequence in range( len( sequence_list ) ):
+                for current_ymer in ymer_dict[ sequence_list[ current_sequence ] ]:
+                    xmer_id = self.xmer_ids.get( current_ymer )
+                    if xmer_id is not None:
+                        indices.append( xmer_id )
+                indptr[ current_sequence + 1 ] = len( indices )
+            indices = np.array( indices, dtype = np.int64 )
+        else:
+            if sequence_list:
+                codes = np.concatenate( [ ymer_dict[ sequence ] for sequence in sequence_list ] )
+            else:
+                codes = np.empty( 0, dtype = self.xmer_codes.dtype )
+            if len( codes ) and codes.dtype != self.xmer_codes.dtype:
+                raise ValueError( "Sequences were encoded with a different window size than the index" )
+
+            positions = np.minimum( np.searchsorted( self.xmer_codes, codes ), max( len( self.xmer_codes ) - 1, 0 ) )
+            found = np.zeros( len( codes ), dtype = bool )
+            if len( self.xmer_codes ):
+                found = self.xmer_codes[ positions ] == codes
+
+            rows = np.repeat( np.arange( len( sequence_list ) ), xmer_counts )
+            indptr = np.zeros( len( sequence_list ) + 1, dtype = np.int64 )
+            np.cumsum( np.bincount( rows[ found ], minlength = len( sequence_list ) ), out = indptr[ 1: ] )
+            indices = positions[ found ]
+
+        query_matrix = sparse.csr_matrix( ( np.ones( len( indices ), dtype = np.int32 ), indices, indptr ),
+                                          shape = ( len( sequence_list ), self.xmer_matrix.shape[ 1 ] )
+                                        )
+        return query_matrix, xmer_counts
+
+    def __len__( self ):
+        return len( self.sequence_list )
+
+    def sequences_with_xmer( self, xmer ):
+        """
+            :returns: numpy array of the ids of the sequences that contain xmer
+        """
+        xmer_id = self._xmer_id( xmer )
+        if xmer_id is None:
+            return np.empty( 0, dtype = self.postings.indices.dtype )
+        return self.postings.indices[ self.postings.indptr[ xmer_id ] : self.postings.indptr[ xmer_id + 1 ] ]
+
+    def _xmer_id( self, xmer ):
+        if self.xmer_codes is None:
+            return self.xmer_ids.get( xmer )
+
+        if len( xmer ) > self.window_size + self.step_size - 1 or 'X' in xmer:
+            return None
+        code = encode_xmers( xmer, len( xmer ), 1 )
+
+        # Pad the code with empty words up to the width of the indexed xmers
+        code_words = np.zeros( len( self.xmer_codes.dtype.descr ), dtype = np.uint64 )
+        code_words[ :len( code.dtype.descr ) ] = code.view( np.uint64 )
+        code = code_words.view( self.xmer_codes.dtype )
+
+        position = np.searchsorted( self.xmer_codes, code )[ 0 ]
+        if position < len( self.xmer_codes ) and self.xmer_codes[ position ] == code[ 0 ]:
+            return position
+        return None
+
+    def shared_xmer_counts( self, start, end ):
+        """
+            Counts the shared xmers of every pair ( i, j ), start <= i < end, i < j,
+            that co-occurs in at least one posting list
+
+            :returns: numpy arrays first, second, and count, one entry per pair found
+        """
+        return shared_xmer_counts( self.xmer_matrix, self.postings, start, end )
+
+def shared_xmer_counts( xmer_matrix, postings, start, end ):
+    """
+        Accumulates shared xmer counts for the rows start <= i < end of xmer_matrix,
+        by walking the posting list of every xmer in each of those rows
 
+        :param xmer_matrix: sparse sequence x xmer CSR matrix
+        :param postings: sparse xmer x sequence CSR matrix, the transpose of xmer_matrix
+
+        :returns: numpy arrays first, second, and count, for each pair first < second
+                  sharing count > 0 xmers
+    """
+    shared = xmer_matrix[ start:end ].dot( postings ).tocoo()
+    first = shared.row.astype( np.int64 ) + start
+    second = shared.col.astype( np.int64 )
+
+    upper = second > first
+    return first[ upper ], second[ upper ], shared.data[ upper ]
+
+# Upper bound on the pairs computed at once, which bounds the temporaries of each tile
+TILE_PAIRS = 1 << 24
+
+# Number of tiles long computations are at least split into while progress is being reported
+PROGRESS_TILES = 100
+
+_progress_callback = None
+
+def set_progress_callback( callback ):
+    """
+        Sets a function to be called as callback( stage, done, total ) while long running
+        computations, such as the distance matrix, make progress. None removes it.
+    """
+    global _progress_callback
+    _progress_callback = callback
+
+def report_progress( stage, done, total ):
+    if _progress_callback is not None:
+        _progress_callback( stage, done, total )
+
+def count_tiles( num_pairs ):
+    """
+        Number of tiles to split num_pairs pairs into, enough to bound each tile's temporaries
+        and, while progress is reported, enough for regular progress updates
+    """
+    num_tiles = max( -( -num_pairs // TILE_PAIRS ), 1 )
+    if _progress_callback is not None:
+        num_tiles = max( num_tiles, PROGRESS_TILES )
+    return num_tiles
+
+def pairs_in_rows( num_items, start, end ):
+    """
+        Number of pairs ( i, j ), start <= i < end, i < j, of num_items items
+    """
+    return ( num_items * end - ( end * ( end + 1 ) ) // 2 ) - ( num_items * start - ( start * ( start + 1 ) ) // 2 )
+
+# uint8 distance vectors store round( distance * QUANTIZED_SCALE )
+QUANTIZED_SCALE = 255 / 100
+
+def quantize_distances( distances, dtype ):
+    """
+        Converts float64 distances to the storage dtype of a distance vector,
+        float64, float32, or uint8, which keeps 255 levels over 0 to 100
+    """
+    dtype = np.dtype( dtype )
+    if dtype == np.uint8:
+        return np.rint( distances * QUANTIZED_SCALE ).astype( np.uint8 )
+    return distances.astype( dtype, copy = False )
+
+def dequantize_distances( out_list ):
+    """
+        Converts (part of) a distance vector stored by quantize_distances back to float64
+    """
+    if out_list.dtype == np.uint8:
+        return out_list / QUANTIZED_SCALE
+    return np.asarray( out_list, dtype = np.float64 )
+
+def create_distance_vector_file( file_name, num_items, dtype = np.float64 ):
+    """
+        Creates a condensed distance vector of num_items items backed by a memory mapped file,
+        so that it does not have to fit in memory
+
+        :param file_name: string name of the file to create, overwritten if it exists
+        :param num_items: integer number of sequences
+        :param dtype: storage dtype, float64, float32, or uint8, see quantize_distances
+
+        :returns: numpy memmap of length num_items * ( num_items - 1 ) / 2
+    """
+    num_pairs = ( num_items * ( num_items - 1 ) ) // 2
+    if num_pairs == 0:
+        open( file_name, 'wb' ).close()
+        return np.zeros( 0, dtype = dtype )
+    return np.memmap( file_name, dtype = dtype, mode = 'w+', shape = ( num_pairs, ) )
+
+def create_condensed_distance_vector( sequence_list, window_size, step_size, ymer_dict = None, num_threads = 1,
+                                      xmer_index = None, out_list = None, dtype = np.float64 ):
+    """
+        Creates the condensed distance vector of a list of sequences, where distance is defined as in
+        get_single_sequence_dist. Shared xmer counts are accumulated only for the pairs that
+        co-occur in a posting list of an XmerIndex, every other pair is at distance 100.
+        The vector is filled in tiles of rows, so only one tile's temporaries are held at a time.
+
+        :param sequence_list: list of string sequences from which to construct the distance vector
+        :param window_size: integer window_size to capture at a time from each sequence
+        :param step_size: integer step_size to use in subset_lists
+        :param ymer_dict: dictionary of sequence: set of ymers, will be created from sequence_list
+                          if none is provided
+        :param num_threads: integer number of worker processes to split the rows of the
+                            pair space between, the result does not depend on it
+        :param xmer_index: XmerIndex of sequence_list, will be created if none is provided
+        :param out_list: vector to fill in, for instance from create_distance_vector_file,
+                         whose dtype sets how distances are stored, see quantize_distances.
+                         An array of dtype is created if none is provided.
+        :param dtype: storage dtype of the created vector, float64, float32, or uint8
+
+        :returns: numpy array of length n * ( n - 1 ) / 2, ordered as
+                  ( 0, 1 ), ( 0, 2 ), ..., ( 1, 2 ), ..., as expected by scipy's linkage
+    """
+    if xmer_index is None:
+        xmer_index = XmerIndex( sequence_list, window_size, step_size, ymer_dict )
+
+    num_seqs = len( xmer_index )
+    xmer_counts = xmer_index.xmer_counts
+
+    check_xmer_counts( xmer_counts )
+
+    num_pairs = ( num_seqs * ( num_seqs - 1 ) ) // 2
+    parallel = num_threads is not None and num_threads > 1 and num_seqs > 1
+
+    shared_array = None
+    if out_list is None:
+        dtype = np.dtype( dtype )
+        if parallel:
+            shared_array = multiprocessing.RawArray( dtype.char, num_pairs )
+            out_list = np.frombuffer( shared_array, dtype = dtype )
+        else:
+            out_list = np.empty( num_pairs, dtype = dtype )
+    elif parallel and not isinstance( out_list, np.memmap ):
+        raise ValueError( "Only distance vectors backed by a file can be shared with worker processes" )
+
+    # Pairs that share no xmers are at distance 100, only the others need computing
+    fill_value = unrelated_distance( out_list.dtype )
+    for start in range( 0, num_pairs, TILE_PAIRS ):
+        out_list[ start : start + TILE_PAIRS ] = fill_value
+
+    num_tiles = count_tiles( num_pairs )
+    pairs_done = 0
+    if not parallel:
+        for start, end in split_condensed_rows( num_seqs, num_tiles ):
+            fill_distance_rows( out_list, xmer_index.xmer_matrix, xmer_index.postings, xmer_counts, start, end )
+            pairs_done += pairs_in_rows( num_seqs, start, end )
+            report_progress( 'distances', pairs_done, num_pairs )
+        return out_list
+
+    if shared_array is not None:
+        out_spec = ( shared_array, out_list.dtype.str )
+    else:
+        out_list.flush()
+        out_spec = ( out_list.filename, out_list.dtype.str, out_list.offset, num_pairs )
+
+    # Several blocks per worker so that no single worker is left with the slowest rows
+    blocks = split_condensed_rows( num_seqs, max( num_threads * 4, num_tiles ) )
+
+    with multiprocessing.Pool( num_threads, initializer = _init_distance_worker,
+                               initargs = ( out_spec, xmer_index.xmer_matrix, xmer_index.postings, xmer_counts )
+                             ) as pool:
+        for block_pairs in pool.imap_unordered( _distance_worker, blocks, chunksize = 1 ):
+            pairs_done += block_pairs
+            report_progress( 'distances', pairs_done, num_pairs )
+
+    return out_list
+
+def fill_distance_rows( out_list, xmer_matrix, postings, xmer_counts, start, end ):
+    """
+        Writes the distances of every pair ( i, j ), start <= i < end, i < j, that shares
+        at least one xmer into the condensed vector out_list. Other pairs are not touched.
+
+        :param out_list: condensed distance vector of all len( xmer_counts ) sequences
+        :param xmer_matrix: sparse sequence x xmer matrix, as from create_xmer_sequence_matrix
+        :param postings: sparse xmer x sequence matrix, the transpose of xmer_matrix
+        :param xmer_counts: numpy array of the number of xmers in each sequence
+        :param start: integer first row to compute
+        :param end: integer row after the last row to compute
+    """
+    first, second, intersection = shared_xmer_counts( xmer_matrix, postings, start, end )
+
+    distances = distances_from_counts( intersection, xmer_counts[ first ], xmer_counts[ second ] )
+    out_list[ condensed_index( len( xmer_counts ), first, second ) ] = quantize_distances( distances, out_list.dtype )
+
+def split_condensed_rows( num_items, num_blocks, start = 0, end = None ):
+    """
+        Splits the rows start <= i < end of a condensed distance vector of num_items items
+        into at most num_blocks contiguous row ranges holding roughly the same number of pairs
+
+        :returns: list of ( start, end ) row ranges covering range( start, end )
+    """
+    if end is None:
+        end = num_items
+    rows = np.arange( start, end + 1, dtype = np.int64 )
+    pairs_before_row = num_items * rows - ( rows * ( rows + 1 ) ) // 2
+    targets = np.linspace( pairs_before_row[ 0 ], pairs_before_row[ -1 ], num_blocks + 1 )
+
+    bounds = np.unique( np.searchsorted( pairs_before_row, targets ) ) + start
+    bounds[ 0 ] = start
+    bounds[ -1 ] = end
+
+    return [ ( int( bounds[ index ] ), int( bounds[ index + 1 ] ) ) for index in range( len( bounds ) - 1 )
+             if bounds[ index ] < bounds[ index + 1 ]
+           ]
+
+def row_costs( xmer_index ):
+    """
+        Estimates the cost of computing the distances of each row of the condensed vector
+        of xmer_index. The shared xmer counts of row i take a step per entry of the posting
+        list of each of its xmers, and writing its distances a step per pair ( i, j ), i < j.
+
+        :returns: numpy array of the cost of each row
+    """
+    posting_lengths = np.diff( xmer_index.postings.indptr ).astype( np.int64 )
+    num_items = len( xmer_index )
+    return xmer_index.xmer_matrix.dot( posting_lengths ) + ( num_items - 1 - np.arange( num_items, dtype = np.int64 ) )
+
+def split_rows_by_cost( costs, num_blocks ):
+    """
+        Splits rows into num_blocks contiguous row ranges of roughly equal total cost.
+        Ranges may be empty when a single row costs more than a block should.
+
+        :param costs: numpy array of the cost of each row, as from row_costs
+
+        :returns: list of num_blocks ( start, end ) row ranges covering range( len( costs ) )
+    """
+    cumulative_costs = np.zeros( len( costs ) + 1, dtype = np.float64 )
+    np.cumsum( costs, out = cumulative_costs[ 1: ] )
+    targets = np.linspace( 0, cumulative_costs[ -1 ], num_blocks + 1 )
+
+    bounds = np.searchsorted( cumulative_costs, targets )
+    bounds[ 0 ] = 0
+    bounds[ -1 ] = len( costs )
+    return [ ( int( bounds[ index ] ), int( bounds[ index + 1 ] ) ) for index in range( num_blocks ) ]
+
+def condensed_distance_rows( xmer_index, start, end, dtype = np.float64 ):
+    """
+        Computes the part of the condensed distance vector of xmer_index holding the pairs
+        ( i, j ), start <= i < end, i < j, which is contiguous in the vector, in tiles
+
+        :param xmer_index: XmerIndex of every sequence
+        :param start: integer first row to compute
+        :param end: integer row after the last row to compute
+        :param dtype: storage dtype of the distances, float64, float32, or uint8
+
+        :returns: numpy array of the distances of the rows, entries
+                  pairs_in_rows( len( xmer_index ), 0, start ) onwards of the full vector
+    """
+    num_seqs = len( xmer_index )
+    xmer_counts = xmer_index.xmer_counts
+    check_xmer_counts( xmer_counts )
+
+    dtype = np.dtype( dtype )
+    num_pairs = pairs_in_rows( num_seqs, start, end )
+    offset = pairs_in_rows( num_seqs, 0, start )
+    out_list = np.full( num_pairs, unrelated_distance( dtype ), dtype = dtype )
+
+    pairs_done = 0
+    if end > start:
+        for tile_start, tile_end in split_condensed_rows( num_seqs, count_tiles( num_pairs ), start, end ):
+            first, second, intersection = shared_xmer_counts( xmer_index.xmer_matrix, xmer_index.postings, tile_start, tile_end )
+            distances = distances_from_counts( intersection, xmer_counts[ first ], xmer_counts[ second ] )
+            out_list[ condensed_index( num_seqs, first, second ) - offset ] = quantize_distances( distances, dtype )
+
+            pairs_done += pairs_in_rows( num_seqs, tile_start, tile_end )
+            report_progress( 'distances', pairs_done, num_pairs )
+    return out_list
+
+_worker_state = {}
+
+def _init_distance_worker( out_spec, xmer_matrix, postings, xmer_counts ):
+    """
+        Pool initializer, hands each worker process the shared output vector and
+        the xmer index matrices once, instead of once per block. out_spec is either a
+        RawArray and its dtype, or the ( file name, dtype, offset, length ) of a memmap.
+    """
+    if len( out_spec ) == 2:
+        shared_array, dtype = out_spec
+        _worker_state[ 'out_list' ] = np.frombuffer( shared_array, dtype = dtype )
+    else:
+        file_name, dtype, offset, length = out_spec
+        _worker_state[ 'out_list' ] = np.memmap( file_name, dtype = dtype, mode = 'r+', offset = offset, shape = ( length, ) )
+    _worker_state[ 'xmer_matrix' ] = xmer_matrix
+    _worker_state[ 'postings' ] = postings
+    _worker_state[ 'xmer_counts' ] = xmer_counts
+
+def _distance_worker( block ):
+    start, end = block
+    fill_distance_rows( _worker_state[ 'out_list' ], _worker_state[ 'xmer_matrix' ], _worker_state[ 'postings' ],
+                        _worker_state[ 'xmer_counts' ], start, end
+                      )
+    return pairs_in_rows( len( _worker_state[ 'xmer_counts' ] ), start, end )
+
+def nearest_references( xmer_index, query_list, num_neighbors, max_distance = None, ymer_dict = None ):
+    """
+        Finds the num_neighbors sequences of xmer_index nearest to each sequence of query_list,
+        where distance is defined as in get_single_sequence_dist. Only the references that share
+        at least one xmer with a query are candidates, as every other reference is at distance 100.
+
+        :param xmer_index: XmerIndex of the reference sequences
+        :param query_list: list of string query sequences
+        :param num_neighbors: integer maximum number of references to find per query
+        :param max_distance: if provided, only references at most this distance away are found
+        :param ymer_dict: dictionary of sequence: xmers of the queries, taken like the xmers of
+                          the index, will be created from query_list if none is provided
+
+        :returns: numpy arrays query, reference, and distances, of the position in query_list of
+                  each query and the id in xmer_index of each of its references, ordered by query
+                  then by increasing distance, ties going to the lower reference id
+    """
     if ymer_dict is None:
-       ymer_dict = {}
-       for current_sequence in range( len( sequence_list) ):
-           ymer_dict[ sequence_list[ current_sequence ] ] = \
-                   subset_lists_iter( sequence_list[ current_sequence ], window_size, step_size )
+        ymer_dict = create_ymer_dict( query_list, xmer_index.window_size, xmer_index.step_size,
+                                      xmer_index.xmer_codes is not None
+                                    )
 
-    
-    for current_sequence in range( len( sequence_list) ):
-        distance_matrix.append(
-                               get_distance_from_other_sequences(
-                                                                 sequence_list[ current_sequence ],
-                                                                 sequence_list, ymer_dict, window_size, step_size
-                                                                 )
-                              )
-    return distance_matrix
+    query_matrix, query_counts = xmer_index.query_matrix( query_list, ymer_dict )
+    shared = query_matrix.dot( xmer_index.postings ).tocoo()
+    query = shared.row.astype( np.int64 )
+    reference = shared.col.astype( np.int64 )
+    distances = distances_from_counts( shared.data, query_counts[ query ], xmer_index.xmer_counts[ reference ] )
+
+    if max_distance is not None:
+        keep = distances <= max_distance
+        query, reference, distances = query[ keep ], reference[ keep ], distances[ keep ]
+
+    order = np.lexsort( ( reference, distances, query ) )
+    query, reference, distances = query[ order ], reference[ order ], distances[ order ]
+
+    rank = np.arange( len( query ) ) - np.searchsorted( query, query )
+    keep = rank < num_neighbors
+    return query[ keep ], reference[ keep ], distances[ keep ]
+
+def query_nearest_references( xmer_index, records, num_neighbors, max_distance = None, batch_size = 1000,
+                              num_threads = 1 ):
+    """
+        Streams records through nearest_references in batches of batch_size, spread over
+        num_threads worker processes. At most two batches per worker are read ahead of the
+        results, so records may come from a file of any size.
+
+        :param xmer_index: XmerIndex of the reference sequences
+        :param records: iterable of ( name, sequence ) query records, e.g. from read_fasta
+
+        :returns: generator of the names of the queries of each batch, in the order of
+                  records, along with the query, reference, and distances arrays of
+                  nearest_references for the batch
+    """
+    batches = _record_batches( records, batch_size )
+    if num_threads <= 1:
+        for names, sequences in batches:
+            yield ( names, ) + nearest_references( xmer_index, sequences, num_neighbors, max_distance )
+        return
+
+    with multiprocessing.Pool( num_threads, initializer = _init_query_worker,
+                               initargs = ( xmer_index, num_neighbors, max_distance )
+                             ) as pool:
+        pending = list()
+        for names, sequences in batches:
+            pending.append( ( names, pool.apply_async( _query_worker, ( sequences, ) ) ) )
+            if len( pending ) >= 2 * num_threads:
+                names, result = pending.pop( 0 )
+                yield ( names, ) + result.get()
+        for names, result in pending:
+            yield ( names, ) + result.get()
+
+def _record_batches( records, batch_size ):
+    names = list()
+    sequences = list()
+    for name, sequence in records:
+        names.append( name )
+        sequences.append( sequence )
+        if len( names ) == batch_size:
+            yield names, sequences
+            names = list()
+            sequences = list()
+    if names:
+        yield names, sequences
+
+def _init_query_worker( xmer_index, num_neighbors, max_distance ):
+    _worker_state[ 'xmer_index' ] = xmer_index
+    _worker_state[ 'num_neighbors' ] = num_neighbors
+    _worker_state[ 'max_distance' ] = max_distance
+
+def _query_worker( sequences ):
+    return nearest_references( _worker_state[ 'xmer_index' ], sequences, _worker_state[ 'num_neighbors' ],
+                               _worker_state[ 'max_distance' ]
+                             )
+
+def condensed_to_square( condensed, num_items ):
+    """
+        Expands a condensed distance vector into a full, symmetric num_items x num_items
+        numpy array, with distance 0 along the diagonal
+    """
+    square = np.zeros( ( num_items, num_items ), dtype = np.float64 )
+    first, second = np.triu_indices( num_items, k = 1 )
+    square[ first, second ] = condensed
+    square[ second, first ] = condensed
+    return square
 
         
 
 
+def condensed_pairs( num_items, indices ):
+    """
+        Inverse of condensed_index, finds the pair ( first, second ) stored at each of
+        indices in a condensed distance vector of num_items items
+
+        :returns: numpy arrays first and second
+    """
+    indices = np.asarray( indices, dtype = np.int64 )
+    rows = np.arange( num_items, dtype = np.int64 )
+    pairs_before_row = num_items * rows - ( rows * ( rows + 1 ) ) // 2
+
+    first = np.searchsorted( pairs_before_row, indices, side = 'right' ) - 1
+    second = indices - pairs_before_row[ first ] + first + 1
+    return first, second
+
+MINHASH_EMPTY = np.uint64( 1 << 32 )
+
+def create_minhash_parameters( num_hashes, seed = 0 ):
+    """
+        Draws the coefficients of num_hashes multiply-shift hash functions
+        ( ( a * x + b ) mod 2^64 ) >> 32, with a odd, of 32-bit values x
+
+        :returns: tuple of numpy uint64 arrays a and b
+    """
+    generator = np.random.default_rng( seed )
+    hash_a = generator.integers( 0, 1 << 64, size = num_hashes, dtype = np.uint64, endpoint = False ) | np.uint64( 1 )
+    hash_b = generator.integers( 0, 1 << 64, size = num_hashes, dtype = np.uint64, endpoint = False )
+    return hash_a, hash_b
+
+def minhash_sketch( xmer_set, hash_parameters ):
+    """
+        Creates the MinHash sketch of a set of xmers, the minimum of each hash function
+        over the set. An empty set gets MINHASH_EMPTY, above any hash value, in every position.
+
+        :param xmer_set: set of string xmers, as from subset_lists_iter
+        :param hash_parameters: tuple of hash coefficients from create_minhash_parameters
+
+        :returns: numpy uint64 array with one value per hash function
+    """
+    hash_a, hash_b = hash_parameters
+
+    if not xmer_set:
+        return np.full( len( hash_a ), MINHASH_EMPTY, dtype = np.uint64 )
+
+    hashed = np.fromiter( ( zlib.crc32( xmer.encode() ) for xmer in xmer_set ),
+                          dtype = np.uint64, count = len( xmer_set )
+                        )
+    # uint64 arithmetic wraps, which is the mod 2^64 of the hash family
+    return ( ( np.outer( hash_a, hashed ) + hash_b[ :, None ] ) >> np.uint64( 32 ) ).min( axis = 1 )
+
+def create_minhash_sketches( sequence_list, window_size, step_size, num_hashes = 128, seed = 0, ymer_dict = None,
+                             num_threads = 1 ):
+    """
+        Creates a fixed-size MinHash sketch for each sequence in sequence_list. Each sequence's
+        xmer set is only held while its sketch is made, unless ymer_dict is provided.
+        Without ymer_dict, blocks of sequences are sketched by num_threads worker processes.
+
+        :returns: numpy uint64 array of shape ( len( sequence_list ), num_hashes ) of sketches,
+                  and numpy array of the exact number of xmers in each sequence
+    """
+    hash_parameters = create_minhash_parameters( num_hashes, seed )
+
+    if num_threads > 1 and ymer_dict is None and len( sequence_list ) > 1:
+        bounds = np.unique( np.linspace( 0, len( sequence_list ), num_threads * 4 + 1 ).astype( np.int64 ) )
+        blocks = [ sequence_list[ start : end ] for start, end in zip( bounds[ :-1 ], bounds[ 1: ] ) ]
+        with multiprocessing.Pool( num_threads, initializer = _init_sketch_worker,
+                                   initargs = ( window_size, step_size, hash_parameters )
+                                 ) as pool:
+            results = pool.map( _sketch_worker, blocks )
+        return np.concatenate( [ result[ 0 ] for result in results ] ), \
+               np.concatenate( [ result[ 1 ] for result in results ] )
+
+    sketches = np.empty( ( len( sequence_list ), num_hashes ), dtype = np.uint64 )
+    xmer_counts = np.empty( len( sequence_list ), dtype = np.int64 )
+
+    for index in range( len( sequence_list ) ):
+        if ymer_dict is None:
+            xmer_set = subset_lists_iter( sequence_list[ index ], window_size, step_size )
+        else:
+            xmer_set = ymer_dict[ sequence_list[ index ] ]
+
+        sketches[ index ] = minhash_sketch( xmer_set, hash_parameters )
+        xmer_counts[ index ] = len( xmer_set )
+
+    return sketches, xmer_counts
+
+def lsh_candidate_pairs( sketches, num_bands ):
+    """
+        Finds the candidate pairs of banded locality sensitive hashing, the pairs whose
+        sketches agree completely on at least one band of num_hashes / num_bands rows
+
+        :param sketches: numpy array of MinHash sketches, one row per sequence
+        :param num_bands: integer number of bands, must divide the sketch size
+
+        :returns: numpy arrays first and second, with first < second, of each distinct candidate pair
+    """
+    num_items, num_hashes = sketches.shape
+    if num_hashes % num_bands:
+        raise ValueError( "Sketch size %d is not divisible into %d bands" % ( num_hashes, num_bands ) )
+    rows_per_band = num_hashes // num_bands
+
+    candidates = list()
+    for band in range( num_bands ):
+        band_values = sketches[ :, band * rows_per_band : ( band + 1 ) * rows_per_band ]
+        _, buckets = np.unique( band_values, axis = 0, return_inverse = True )
+        buckets = buckets.ravel()
+
+        # Sorted by bucket, each member pairs with the members after it in its bucket's run
+        order = np.argsort( buckets, kind = 'stable' )
+        run_starts = np.flatnonzero( np.r_[ True, np.diff( buckets[ order ] ) != 0 ] )
+        run_ends = np.r_[ run_starts[ 1: ], num_items ]
+        run_lengths = run_ends - run_starts
+
+        partners = np.repeat( run_ends, run_lengths ) - 1 - np.arange( num_items )
+        num_pairs = int( partners.sum() )
+        if num_pairs == 0:
+            continue
+
+        first = np.repeat( np.arange( num_items ), partners )
+        second = first + 1 + np.arange( num_pairs ) - np.repeat( np.cumsum( partners ) - partners, partners )
+        members_first = order[ first ]
+        members_second = order[ second ]
+        candidates.append( condensed_index( num_items, np.minimum( members_first, members_second ),
+                                            np.maximum( members_first, members_second )
+                                          )
+                         )
+
+    if not candidates:
+        empty = np.empty( 0, dtype = np.int64 )
+        return empty, empty
+    return condensed_pairs( num_items, np.unique( np.concatenate( candidates ) ) )
+
+def _init_sketch_worker( window_size, step_size, hash_parameters ):
+    _worker_state[ 'window_size' ] = window_size
+    _worker_state[ 'step_size' ] = step_size
+    _worker_state[ 'hash_parameters' ] = hash_parameters
+
+def _sketch_worker( sequence_list ):
+    hash_parameters = _worker_state[ 'hash_parameters' ]
+    sketches = np.empty( ( len( sequence_list ), len( hash_parameters[ 0 ] ) ), dtype = np.uint64 )
+    xmer_counts = np.empty( len( sequence_list ), dtype = np.int64 )
+    for index in range( len( sequence_list ) ):
+        xmer_set = subset_lists_iter( sequence_list[ index ], _worker_state[ 'window_size' ], _worker_state[ 'step_size' ] )
+        sketches[ index ] = minhash_sketch( xmer_set, hash_parameters )
+        xmer_counts[ index ] = len( xmer_set )
+    return sketches, xmer_counts
+
+def estimate_minhash_distances( sketches, xmer_counts, first, second, chunk_size = 100000 ):
+    """
+        Estimates the distance of get_single_sequence_dist for each pair ( first, second ).
+        The fraction of agreeing sketch positions estimates the Jaccard index J, which with the
+        exact set sizes gives the shared xmer count J * ( |A| + |B| ) / ( 1 + J ).
+
+        :returns: numpy float64 array of estimated distances
+    """
+    distances = np.empty( len( first ), dtype = np.float64 )
+
+    for start in range( 0, len( first ), chunk_size ):
+        current_first = first[ start : start + chunk_size ]
+        current_second = second[ start : start + chunk_size ]
+
+        jaccard = np.mean( sketches[ current_first ] == sketches[ current_second ], axis = 1 )
+        first_sizes = xmer_counts[ current_first ]
+        second_sizes = xmer_counts[ current_second ]
+
+        intersection = jaccard * ( first_sizes + second_sizes ) / ( 1 + jaccard )
+        intersection = np.minimum( intersection, np.minimum( first_sizes, second_sizes ) )
+
+        distances[ start : start + chunk_size ] = distances_from_counts( intersection, first_sizes, second_sizes )
+    return distances
+
+def approximate_distance_edges( sequence_list, window_size, step_size, num_hashes = 128, num_bands = 64,
+                                seed = 0, ymer_dict = None, num_threads = 1 ):
+    """
+        Finds the candidate pairs of banded LSH over MinHash sketches of each sequence,
+        and estimates their distances from the sketches
+
+        :param num_threads: integer number of processes to sketch the sequences with
+
+        :returns: numpy arrays first, second, and distances, one entry per candidate pair
+    """
+    sketches, xmer_counts = create_minhash_sketches( sequence_list, window_size, step_size,
+                                                     num_hashes, seed, ymer_dict, num_threads
+                                                   )
+    check_xmer_counts( xmer_counts )
+
+    first, second = lsh_candidate_pairs( sketches, num_bands )
+    return first, second, estimate_minhash_distances( sketches, xmer_counts, first, second )
+
+def approximate_condensed_distance_vector( sequence_list, window_size, step_size, num_hashes = 128, num_bands = 64,
+                                           seed = 0, ymer_dict = None, out_list = None, dtype = np.float64,
+                                           num_threads = 1 ):
+    """
+        Approximate version of create_condensed_distance_vector. Pairs are only compared if
+        banded LSH over MinHash sketches marks them as candidates, and their distances are
+        estimated from the sketches. Every other pair is at distance 100.
+
+        :param sequence_list: list of string sequences from which to construct the distance vector
+        :param window_size: integer window_size to capture at a time from each sequence
+        :param step_size: integer step_size to use in subset_lists
+        :param num_hashes: integer size of each sketch, larger sketches give better estimates
+        :param num_bands: integer number of LSH bands, more bands find more distant candidates
+        :param seed: integer seed of the hash functions
+        :param ymer_dict: optional dictionary of sequence: set of ymers
+        :param out_list: optional vector to fill in, as in create_condensed_distance_vector
+        :param dtype: storage dtype of the vector created if out_list is not provided
+        :param num_threads: integer number of processes to sketch the sequences with
+
+        :returns: numpy condensed distance vector
+    """
+    first, second, distances = approximate_distance_edges( sequence_list, window_size, step_size,
+                                                           num_hashes, num_bands, seed, ymer_dict, num_threads
+                                                         )
+    num_seqs = len( sequence_list )
+    num_pairs = ( num_seqs * ( num_seqs - 1 ) ) // 2
+    if out_list is None:
+        out_list = np.empty( num_pairs, dtype = dtype )
+
+    fill_value = unrelated_distance( out_list.dtype )
+    for start in range( 0, num_pairs, TILE_PAIRS ):
+        out_list[ start : start + TILE_PAIRS ] = fill_value
+
+    out_list[ condensed_index( num_seqs, first, second ) ] = quantize_distances( distances, out_list.dtype )
+    return out_list
+
+def approximate_distance_error( sequence_list, out_list, window_size, step_size, sample_size = 1000, seed = 0 ):
+    """
+        Compares a sample of the distances in an approximate condensed vector against
+        the exact distances of get_single_sequence_dist. Half of the sample is drawn from
+        all pairs, the other half from the pairs the approximation placed below 100.
+
+        :returns: dictionary with the number of 'pairs' compared, the 'mean_error' and
+                  'max_error' of the absolute differences, and the number of pairs 'missed',
+                  those with an exact distance below 100 that the approximation put at 100
+    """
+    generator = np.random.default_rng( seed )
+    num_seqs = len( sequence_list )
+
+    close_pairs = np.flatnonzero( out_list < unrelated_distance( out_list.dtype ) )
+    sample = generator.choice( len( out_list ), size = min( sample_size // 2, len( out_list ) ), replace = False )
+    if len( close_pairs ):
+        sample = np.union1d( sample, generator.choice( close_pairs, size = min( sample_size - len( sample ), len( close_pairs ) ),
+                                                       replace = False
+                                                     )
+                           )
+
+    first, second = condensed_pairs( num_seqs, sample )
+    errors = list()
+    missed = 0
+    for index in range( len( sample ) ):
+        exact = get_single_sequence_dist( subset_lists_iter( sequence_list[ first[ index ] ], window_size, step_size ),
+                                          subset_lists_iter( sequence_list[ second[ index ] ], window_size, step_size ),
+                                          window_size, step_size
+                                        )
+        approximate = dequantize_distances( out_list[ sample[ index ] : sample[ index ] + 1 ] )[ 0 ]
+        errors.append( abs( exact - approximate ) )
+        if exact < 100 and approximate == 100:
+            missed += 1
+
+    return { 'pairs': len( errors ),
+             'mean_error': float( np.mean( errors ) ) if errors else 0.0,
+             'max_error': float( np.max( errors ) ) if errors else 0.0,
+             'missed': missed
+           }
+
+def create_distance_edges( sequence_list, window_size, step_size, ymer_dict = None, xmer_index = None,
+                           max_distance = None ):
+    """
+        Computes the distances of only the pairs of sequences that share at least one xmer,
+        the edges of a sparse graph. Every pair left out is at distance 100.
+
+        :param sequence_list: list of string sequences
+        :param window_size: integer window_size to capture at a time from each sequence
+        :param step_size: integer step_size to use in subset_lists
+        :param ymer_dict: dictionary of sequence: set of ymers, will be created from sequence_list
+                          if none is provided
+        :param xmer_index: XmerIndex of sequence_list, will be created if none is provided
+        :param max_distance: if provided, only edges at most this distance apart are kept
+
+        :returns: numpy arrays first, second, and distances, with first < second
+    """
+    edges = list( distance_edge_chunks( sequence_list, window_size, step_size, ymer_dict, xmer_index, max_distance ) )
+
+    if not edges:
+        return np.empty( 0, dtype = np.int64 ), np.empty( 0, dtype = np.int64 ), np.empty( 0, dtype = np.float64 )
+    return tuple( np.concatenate( part ) for part in zip( *edges ) )
+
+def distance_edge_chunks( sequence_list, window_size, step_size, ymer_dict = None, xmer_index = None,
+                          max_distance = None, start = 0, end = None ):
+    """
+        Generator version of create_distance_edges, yielding the edges of one tile of rows
+        at a time, so that the edges never have to be held in memory all at once. Only the
+        edges of rows start <= i < end are found.
+
+        :returns: generator of numpy arrays first, second, and distances, with first < second
+    """
+    if xmer_index is None:
+        xmer_index = XmerIndex( sequence_list, window_size, step_size, ymer_dict )
+
+    num_seqs = len( xmer_index )
+    xmer_counts = xmer_index.xmer_counts
+    check_xmer_counts( xmer_counts )
+
+    if end is None:
+        end = num_seqs
+    if end <= start:
+        return
+
+    num_pairs = pairs_in_rows( num_seqs, start, end )
+    pairs_done = 0
+    for tile_start, tile_end in split_condensed_rows( num_seqs, count_tiles( num_pairs ), start, end ):
+        first, second, intersection = shared_xmer_counts( xmer_index.xmer_matrix, xmer_index.postings, tile_start, tile_end )
+        distances = distances_from_counts( intersection, xmer_counts[ first ], xmer_counts[ second ] )
+
+        if max_distance is not None:
+            keep = distances <= max_distance
+            first, second, distances = first[ keep ], second[ keep ], distances[ keep ]
+
+        pairs_done += pairs_in_rows( num_seqs, tile_start, tile_end )
+        report_progress( 'distance edges', pairs_done, num_pairs )
+        yield first, second, distances
+
+def condensed_edge_chunks( out_list, num_items, max_distance = None, chunk_size = TILE_PAIRS ):
+    """
+        Reads the pairs of a condensed distance vector at most max_distance apart, or if
+        max_distance is None, the pairs closer than 100, which are those sharing xmers,
+        chunk_size entries of the vector at a time
+
+        :returns: generator of numpy arrays first, second, and distances, with first < second
+    """
+    for start in range( 0, len( out_list ), chunk_size ):
+        distances = dequantize_distances( out_list[ start : start + chunk_size ] )
+        if max_distance is None:
+            keep = np.flatnonzero( distances < 100 )
+        else:
+            keep = np.flatnonzero( distances <= max_distance )
+        first, second = condensed_pairs( num_items, keep + start )
+        yield first, second, distances[ keep ]
+
+def single_linkage_from_edges( num_items, first, second, distances, missing_distance = 100.0 ):
+    """
+        Builds the single linkage of num_items items from a sparse graph of the distances that
+        are known, every pair without an edge being at missing_distance. Single linkage merges
+        along a minimum spanning tree, so only the tree of the graph is ever ordered and merged.
+
+        :param num_items: integer number of items
+        :param first: numpy array of the first item of each edge
+        :param second: numpy array of the second item of each edge
+        :param distances: numpy array of the distance of each edge
+        :param missing_distance: float distance of the pairs that are not edges
+
+        :returns: linkage matrix in the format of scipy.cluster.hierarchy.linkage, for use
+                  with fcluster
+    """
+    from scipy import sparse
+    from scipy.sparse import csgraph
+
+    if num_items < 2:
+        return np.empty( ( 0, 4 ), dtype = np.float64 )
+
+    # The tree is found over distance ranks, as csgraph would drop edges of distance 0
+    levels, ranks = np.unique( distances, return_inverse = True )
+    graph = sparse.coo_matrix( ( ranks.ravel() + 1.0, ( first, second ) ), shape = ( num_items, num_items ) ).tocsr()
+    tree = csgraph.minimum_spanning_tree( graph ).tocoo()
+
+    tree_first = tree.row.astype( np.int64 )
+    tree_second = tree.col.astype( np.int64 )
+    tree_distances = levels[ tree.data.astype( np.int64 ) - 1 ]
+
+    # Items the graph leaves apart are joined at missing_distance
+    num_components, component_labels = csgraph.connected_components( graph, directed = False )
+    if num_components > 1:
+        representatives = np.unique( component_labels, return_index = True )[ 1 ]
+        tree_first = np.concatenate( [ tree_first, np.repeat( representatives[ 0 ], num_components - 1 ) ] )
+        tree_second = np.concatenate( [ tree_second, representatives[ 1: ] ] )
+        tree_distances = np.concatenate( [ tree_distances, np.full( num_components - 1, float( missing_distance ) ) ] )
+
+    order = np.argsort( tree_distances, kind = 'stable' )
+
+    parent = np.arange( 2 * num_items - 1 )
+    sizes = np.ones( 2 * num_items - 1, dtype = np.int64 )
+    Z = np.empty( ( num_items - 1, 4 ), dtype = np.float64 )
+
+    for merge, edge in enumerate( order ):
+        roots = list()
+        for node in ( tree_first[ edge ], tree_second[ edge ] ):
+            while parent[ node ] != node:
+                parent[ node ] = parent[ parent[ node ] ]
+                node = parent[ node ]
+            roots.append( node )
+
+        new_cluster = num_items + merge
+        parent[ roots[ 0 ] ] = new_cluster
+        parent[ roots[ 1 ] ] = new_cluster
+        sizes[ new_cluster ] = sizes[ roots[ 0 ] ] + sizes[ roots[ 1 ] ]
+        Z[ merge ] = ( min( roots ), max( roots ), tree_distances[ edge ], sizes[ new_cluster ] )
+
+    return Z
+
+def greedy_clusters( sequence_list, window_size, step_size, max_distance, ymer_dict = None ):
+    """
+        Clusters sequences greedily, in the order of sequence_list, longest first for the
+        usual redundancy reduction. Each sequence joins the first representative at most
+        max_distance from it, where distance is defined as in get_single_sequence_dist, or
+        otherwise becomes the representative of a new cluster. Representatives are found
+        through an inverted index of their xmers, so each sequence is only compared with
+        the representatives it shares xmers with.
+
+        :param sequence_list: list of string sequences
+        :param window_size: integer window_size to capture at a time from each sequence
+        :param step_size: integer step_size to use in subset_lists
+        :param max_distance: float maximum distance of a sequence to its representative
+        :param ymer_dict: dictionary of sequence: xmers, will be created from sequence_list
+                          if none is provided
+
+        :returns: numpy array of the cluster of each sequence, numbered from 1 in the order
+                  the clusters were created, and numpy array of the position in sequence_list
+                  of the representative of each cluster
+    """
+    if ymer_dict is None:
+        ymer_dict = create_ymer_dict( sequence_list, window_size, step_size )
+
+    # Xmer: list of the clusters whose representative has it
+    postings = {}
+    representative_sizes = np.empty( len( sequence_list ), dtype = np.int64 )
+    representatives = list()
+    labels = np.empty( len( sequence_list ), dtype = np.int64 )
+
+    for index in range( len( sequence_list ) ):
+        xmers = ymer_dict[ sequence_list[ index ] ]
+        if isinstance( xmers, np.ndarray ):
+            xmers = xmers.tolist()
+
+        hits = [ postings[ xmer ] for xmer in xmers if xmer in postings ]
+        cluster = None
+        if hits:
+            clusters, shared = np.unique( np.concatenate( hits ), return_counts = True )
+            distances = distances_from_counts( shared, len( xmers ), representative_sizes[ clusters ] )
+            within = clusters[ distances <= max_distance ]
+            if len( within ):
+                cluster = within[ 0 ]
+
+        # Representatives sharing no xmers are at distance 100
+        if cluster is None and representatives and max_distance >= 100:
+            cluster = 0
+
+        if cluster is None:
+            cluster = len( representatives )
+            representatives.append( index )
+            representative_sizes[ cluster ] = len( xmers )
+            for xmer in xmers:
+                postings.setdefault( xmer, list() ).append( cluster )
+
+        labels[ index ] = cluster + 1
+
+    return labels, np.array( representatives, dtype = np.int64 )
+
+def tree_from_linkage( Z ):
+    """
+        Gets a spanning tree with the merges of the single linkage Z, one edge between a
+        member of each side of every merge, at the merge's distance. The single linkage of
+        the tree and any further edges is the single linkage of every pair Z was built from
+        and those edges, so the tree can stand in for them when items are added.
+
+        :returns: numpy arrays first, second, and distances of the len( Z ) edges
+    """
+    num_items = len( Z ) + 1
+    representatives = np.empty( 2 * num_items - 1, dtype = np.int64 )
+    representatives[ :num_items ] = np.arange( num_items )
+
+    first = np.empty( len( Z ), dtype = np.int64 )
+    second = np.empty( len( Z ), dtype = np.int64 )
+    for merge in range( len( Z ) ):
+        first[ merge ] = representatives[ int( Z[ merge, 0 ] ) ]
+        second[ merge ] = representatives[ int( Z[ merge, 1 ] ) ]
+        representatives[ num_items + merge ] = first[ merge ]
+    return first, second, np.array( Z[ :, 2 ], dtype = np.float64 )
+
+def appended_distance_rows( xmer_index, num_old ):
+    """
+        Computes the distances of each sequence of xmer_index from position num_old on to
+        every sequence before it, all that is needed when those sequences were appended
+        to an index of num_old sequences whose distances are known. Work is split into
+        tiles of rows, bounded by TILE_PAIRS pairs.
+
+        :param xmer_index: XmerIndex of the old sequences followed by the new ones
+        :param num_old: integer number of old sequences
+
+        :returns: generator of the rows start, end of each tile, and numpy arrays first,
+                  second, and distances of the pairs of items start <= k < end and i < k
+                  sharing xmers
+    """
+    num_seqs = len( xmer_index )
+    xmer_counts = xmer_index.xmer_counts
+    check_xmer_counts( xmer_counts )
+
+    num_pairs = ( num_seqs * ( num_seqs - 1 ) - num_old * ( num_old - 1 ) ) // 2
+    pairs_done = 0
+    for start, end in lower_triangle_tiles( num_old, num_seqs ):
+        shared = xmer_index.xmer_matrix[ start:end ].dot( xmer_index.postings ).tocoo()
+        second = shared.row.astype( np.int64 ) + start
+        first = shared.col.astype( np.int64 )
+        lower = first < second
+        first, second, intersection = first[ lower ], second[ lower ], shared.data[ lower ]
+        distances = distances_from_counts( intersection, xmer_counts[ first ], xmer_counts[ second ] )
+
+        pairs_done += ( end * ( end - 1 ) - start * ( start - 1 ) ) // 2
+        report_progress( 'appended distances', pairs_done, num_pairs )
+        yield start, end, first, second, distances
+
+def cluster_distance_statistics( labels, out_list = None, sequence_list = None, window_size = None, step_size = None,
+                                 ymer_dict = None ):
+    """
+        Computes the minimum, mean, and maximum distance between the members of each cluster,
+        reading the within-cluster pairs straight out of an existing condensed distance vector.
+        If no vector is provided, the distances within each cluster are computed instead.
+
+        :param labels: numpy array of the cluster label of each sequence, as from fcluster
+        :param out_list: condensed distance vector of all of the sequences, may be quantized
+        :param sequence_list: list of string sequences, only needed without out_list
+        :param window_size: integer window_size, only needed without out_list
+        :param step_size: integer step_size, only needed without out_list
+        :param ymer_dict: optional dictionary of sequence: xmers, only used without out_list
+
+        :returns: dictionary of numpy arrays with one entry per cluster, in increasing order of label:
+                  'cluster', 'size', 'pairs', 'total', 'min', 'mean', and 'max'.
+                  Distances of clusters with a single member are nan.
+    """
+    labels = np.asarray( labels )
+    num_items = len( labels )
+    clusters, sizes = np.unique( labels, return_counts = True )
+
+    totals = np.zeros( len( clusters ), dtype = np.float64 )
+    minimums = np.full( len( clusters ), np.nan )
+    maximums = np.full( len( clusters ), np.nan )
+
+    order = np.argsort( labels, kind = 'stable' )
+    members_of_clusters = np.split( order, np.cumsum( sizes )[ :-1 ] )
+
+    for cluster_index, members in enumerate( members_of_clusters ):
+        if len( members ) < 2:
+            continue
+
+        if out_list is None:
+            member_sequences = [ sequence_list[ member ] for member in members ]
+            chunks = [ create_condensed_distance_vector( member_sequences, window_size, step_size, ymer_dict ) ]
+        else:
+            chunks = _cluster_distance_chunks( out_list, num_items, members )
+
+        for distances in chunks:
+            totals[ cluster_index ] += distances.sum()
+            minimums[ cluster_index ] = np.fmin( minimums[ cluster_index ], distances.min() )
+            maximums[ cluster_index ] = np.fmax( maximums[ cluster_index ], distances.max() )
+
+    pairs = ( sizes * ( sizes - 1 ) ) // 2
+    with np.errstate( invalid = 'ignore', divide = 'ignore' ):
+        means = np.where( pairs > 0, totals / pairs, np.nan )
+
+    return { 'cluster': clusters, 'size': sizes, 'pairs': pairs, 'total': totals,
+             'min': minimums, 'mean': means, 'max': maximums
+           }
+
+def _cluster_distance_chunks( out_list, num_items, members ):
+    """
+        Helper of cluster_distance_statistics, yields the float64 distances between the sorted
+        members of one cluster, at most about TILE_PAIRS at a time
+    """
+    members = np.sort( members )
+    start = 0
+    while start < len( members ) - 1:
+        # Member row takes len( members ) - row - 1 pairs, fit as many rows as the tile allows
+        remaining = len( members ) - 1 - np.arange( start, len( members ) - 1 )
+        end = start + max( int( np.searchsorted( np.cumsum( remaining ), TILE_PAIRS, side = 'right' ) ), 1 )
+
+        rows = np.arange( start, end )
+        first = np.repeat( rows, len( members ) - 1 - rows )
+        second = np.concatenate( [ np.arange( row + 1, len( members ) ) for row in rows ] )
+
+        yield dequantize_distances( out_list[ condensed_index( num_items, members[ first ], members[ second ] ) ] )
+        start = end
+
+def cluster_species_metrics( labels, species ):
+    """
+        Computes species statistics of each cluster and of each species, grouping all
+        sequences at once
+
+        :param labels: numpy array of the cluster label of each sequence
+        :param species: numpy array of the integer species of each sequence, for instance
+                        taxids from taxid_array, where sequences of unknown species share one value
+
+        :returns: dictionary of numpy arrays. 'cluster', 'size', 'species', the number of distinct
+                  species, 'purity', the fraction of members of the most common species, and
+                  'dominant', the index in 'species_ids' of that species, for each cluster in
+                  increasing order of label. 'species_ids' and 'spread', the number of clusters
+                  each species is found in, for each species in increasing order.
+    """
+    clusters, cluster_codes = np.unique( np.asarray( labels ), return_inverse = True )
+    species_ids, species_codes = np.unique( np.asarray( species ), return_inverse = True )
+    cluster_codes = cluster_codes.ravel().astype( np.int64 )
+    species_codes = species_codes.ravel().astype( np.int64 )
+
+    # Each distinct ( cluster, species ) pair, sorted by cluster, with its number of members
+    pairs, pair_counts = np.unique( cluster_codes * len( species_ids ) + species_codes, return_counts = True )
+    pair_clusters = pairs // len( species_ids )
+    pair_species = pairs % len( species_ids )
+
+    sizes = np.bincount( cluster_codes, minlength = len( clusters ) )
+    cluster_starts = np.searchsorted( pair_clusters, np.arange( len( clusters ) ) )
+    dominant_counts = np.maximum.reduceat( pair_counts, cluster_starts )
+
+    # Ties go to the lowest species
+    dominant_pairs = np.flatnonzero( pair_counts == dominant_counts[ pair_clusters ] )
+    dominant_pairs = dominant_pairs[ np.unique( pair_clusters[ dominant_pairs ], return_index = True )[ 1 ] ]
+
+    return { 'cluster': clusters, 'size': sizes,
+             'species': np.bincount( pair_clusters, minlength = len( clusters ) ),
+             'purity': dominant_counts / sizes, 'dominant': pair_species[ dominant_pairs ],
+             'species_ids': species_ids, 'spread': np.bincount( pair_species, minlength = len( species_ids ) )
+           }
+
 def sort_sequences_by_length( names_list, sequence_list ):
     sequence_dict = {}
 
@@ -377,7 +2038,7 @@ def get_taxid_from_name( in_name ):
     split_name = in_name.split( 'TaxID=' )
 
     # uniprot naming convention
-    if len( split_name == 1 ):
+    if len( split_name ) == 1:
         split_name = in_name.split( 'OX=' )
 
     return_name = None
@@ -387,17 +2048,50 @@ def get_taxid_from_name( in_name ):
     return return_name
 
 
+MISSING_TAXID = -1
+
+# One match per line, the TaxID= of a uniref name in the first group, else the OX= of a
+# uniprot name in the second
+_taxid_line_pattern = re.compile( r'^(?:.*?TaxID=(\d+))?(?:.*?OX=(\d+))?.*$', re.MULTILINE )
+
+def taxid_array( names ):
+    """
+        Gets the integer taxonomic id of every name in names with a single pass of one
+        regular expression over all of them, uniref's TaxID= taking precedence over
+        uniprot's OX= as in get_taxid_from_name
+
+        :param names: list of string names of genetic sequences
+        :returns: numpy int64 array of the taxid of each name, in order, MISSING_TAXID for
+                  names that have none
+    """
+    taxids = np.full( len( names ), MISSING_TAXID, dtype = np.int64 )
+    if not names:
+        return taxids
+
+    for index, match in enumerate( _taxid_line_pattern.finditer( '\n'.join( names ) ) ):
+        taxid = match.group( 1 ) or match.group( 2 )
+        if taxid:
+            taxids[ index ] = int( taxid )
+    return taxids
+
 def get_species_from_file( in_file ):
+    """
+        Reads a file of taxid|species lines
+
+        :returns: dictionary of integer taxid: list of the species names given for it, in file order
+    """
     open_file = open( in_file, 'r' )
     taxid_dict = {}
 
     for line in open_file:
         line = line.split( '|' )
-        taxID = line[ 0 ].strip()
+        if len( line ) < 2:
+            continue
+        taxID = int( line[ 0 ].strip() )
         species = line[ 1 ].strip()
 
         if taxID not in taxid_dict:
-            taxid_dict[ int( taxID ) ] = list()
+            taxid_dict[ taxID ] = list()
         taxid_dict[ taxID ].append( species )
     open_file.close()
 
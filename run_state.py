@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+import json
+import os
+import numpy as np
+import protein_oligo_library as oligo
+
+STATE_VERSION = 2
+
+
+def save_state( state_dir, names, sequences, window_size, step_size, xmer_index, Z ):
+    """
+        Saves a clustering run, so that sequences can later be added to it with append_sequences
+        without computing the distances between the sequences already in it again.
+
+        The state holds the sequences in clustering order, the XmerIndex of the sequences, and
+        a spanning tree with the merges of the single linkage Z. The tree is all the new
+        linkage needs from the saved distances, so they are not kept.
+
+        :param state_dir: string directory to save the state in, created if it does not exist
+        :param names: list of the names of sequences
+        :param sequences: list of string sequences, in the order they were clustered
+        :param window_size: integer window_size the xmers were taken with
+        :param step_size: integer step_size the xmers were taken with
+        :param xmer_index: XmerIndex of sequences
+        :param Z: single linkage matrix of sequences
+    """
+    os.makedirs( state_dir, exist_ok = True )
+    write_state( state_dir, names, sequences, window_size, step_size, xmer_index, Z )
+
+def load_state( state_dir ):
+    """
+        Loads a state saved by save_state
+
+        :returns: dictionary of the state's 'meta' data, 'names', 'sequences', 'xmer_index',
+                  and 'tree', a tuple of numpy arrays first, second, and distances
+    """
+    meta = load_meta( state_dir, 'run' )
+    names, sequences, xmer_index = read_index( state_dir, meta )
+
+    tree = np.load( os.path.join( state_dir, 'tree.npz' ) )
+    return { 'meta': meta, 'names': names, 'sequences': sequences, 'xmer_index': xmer_index,
+             'tree': ( tree[ 'first' ], tree[ 'second' ], tree[ 'distances' ] )
+           }
+
+def save_reference( reference_dir, names, sequences, window_size, step_size, xmer_index ):
+    """
+        Saves the XmerIndex of reference sequences, so that the references nearest to query
+        sequences can be found without indexing the references again
+
+        :param reference_dir: string directory to save the references in, created if it does not exist
+        :param names: list of the names of the reference sequences
+        :param sequences: list of string reference sequences
+        :param window_size: integer window_size the xmers were taken with
+        :param step_size: integer step_size the xmers were taken with
+        :param xmer_index: XmerIndex of sequences
+    """
+    os.makedirs( reference_dir, exist_ok = True )
+    encode = write_index( reference_dir, names, sequences, xmer_index )
+    write_meta( reference_dir, { 'kind': 'reference', 'num_items': len( sequences ), 'window_size': window_size,
+                                 'step_size': step_size, 'encode': encode
+                               }
+              )
+
+def load_reference( reference_dir ):
+    """
+        Loads references saved by save_reference
+
+        :returns: dictionary of the references' 'meta' data, 'names', 'sequences', and 'xmer_index'
+    """
+    meta = load_meta( reference_dir, 'reference' )
+    names, sequences, xmer_index = read_index( reference_dir, meta )
+    return { 'meta': meta, 'names': names, 'sequences': sequences, 'xmer_index': xmer_index }
+
+def load_meta( state_dir, kind = 'run' ):
+    """
+        Loads the meta data of a state saved by save_state or save_reference: its 'num_items',
+        'window_size', 'step_size', and whether xmers were encoded
+
+        :param kind: string kind of state expected, 'run' or 'reference'
+
+        :raises ValueError: if state_dir does not hold a state of kind this version can read
+    """
+    meta_file = os.path.join( state_dir, 'meta.json' )
+    if not os.path.isfile( meta_file ):
+        raise ValueError( "%s does not contain a saved %s" % ( state_dir, kind ) )
+
+    with open( meta_file, 'r' ) as open_file:
+        meta = json.load( open_file )
+    if meta.get( 'version' ) != STATE_VERSION:
+        raise ValueError( "%s was saved by an incompatible version" % state_dir )
+    if meta.get( 'kind' ) != kind:
+        raise ValueError( "%s does not contain a saved %s" % ( state_dir, kind ) )
+    return meta
+
+def append_sequences( state_dir, names, sequences, ymer_dict ):
+    """
+        Adds sequences to a saved run. Only the distances from each new sequence to the
+        sequences before it are computed. The new linkage is built from the saved tree and
+        the new pairs that share xmers, which is the single linkage of every pair.
+        The saved state is updated to include the new sequences. Sequences already in the
+        state, or repeated among the new ones, are added once, as a full run would.
+
+        :param state_dir: string directory of a state saved by save_state
+        :param names: list of the names of the new sequences
+        :param sequences: list of new string sequences
+        :param ymer_dict: dictionary of sequence: xmers of the new sequences, taken like the
+                          saved ones, see the state's meta data
+
+        :returns: lists of the names and sequences of the run, saved followed by new,
+                  and the single linkage matrix of all of them
+    """
+    state = load_state( state_dir )
+    meta = state[ 'meta' ]
+    xmer_index = state[ 'xmer_index' ]
+    num_old = meta[ 'num_items' ]
+
+    known_sequences = set( state[ 'sequences' ] )
+    new_names = list()
+    new_sequences = list()
+    for name, sequence in zip( names, sequences ):
+        if sequence not in known_sequences:
+            known_sequences.add( sequence )
+            new_names.append( name )
+            new_sequences.append( sequence )
+    names, sequences = new_names, new_sequences
+
+    xmer_index.append_sequences( sequences, ymer_dict )
+    num_items = len( xmer_index )
+
+    edges = [ state[ 'tree' ] ]
+    for start, end, first, second, distances in oligo.appended_distance_rows( xmer_index, num_old ):
+        edges.append( ( first, second, distances ) )
+
+    first, second, distances = ( np.concatenate( part ) for part in zip( *edges ) )
+    Z = oligo.single_linkage_from_edges( num_items, first, second, distances )
+
+    names = state[ 'names' ] + list( names )
+    sequences = state[ 'sequences' ] + list( sequences )
+    write_state( state_dir, names, sequences, meta[ 'window_size' ], meta[ 'step_size' ], xmer_index, Z )
+    return names, sequences, Z
+
+def write_state( state_dir, names, sequences, window_size, step_size, xmer_index, Z ):
+    """
+        Writes a state. The meta data is written last, and its number of sequences is
+        what the rest of the state is read against.
+    """
+    # Distances saved by earlier versions are no longer kept up to date
+    if os.path.exists( os.path.join( state_dir, 'distances.dat' ) ):
+        os.remove( os.path.join( state_dir, 'distances.dat' ) )
+
+    encode = write_index( state_dir, names, sequences, xmer_index )
+
+    first, second, distances = oligo.tree_from_linkage( Z )
+    np.savez( os.path.join( state_dir, 'tree.npz' ), first = first, second = second, distances = distances )
+
+    write_meta( state_dir, { 'kind': 'run', 'num_items': len( sequences ), 'window_size': window_size,
+                             'step_size': step_size, 'encode': encode
+                           }
+              )
+
+def write_meta( state_dir, meta ):
+    meta = dict( meta, version = STATE_VERSION )
+    with open( os.path.join( state_dir, 'meta.json' ), 'w' ) as out_file:
+        json.dump( meta, out_file )
+
+def write_index( state_dir, names, sequences, xmer_index ):
+    """
+        Writes the sequences and XmerIndex of a state
+
+        :returns: boolean, whether the xmers of the index are encoded
+    """
+    from scipy import sparse
+
+    oligo.write_fastas( names, sequences, os.path.join( state_dir, 'sequences.fasta' ) )
+    sparse.save_npz( os.path.join( state_dir, 'xmer_matrix.npz' ), xmer_index.xmer_matrix )
+
+    encode = xmer_index.xmer_codes is not None
+    if encode:
+        np.save( os.path.join( state_dir, 'xmer_codes.npy' ), xmer_index.xmer_codes )
+    else:
+        xmers = sorted( xmer_index.xmer_ids, key = xmer_index.xmer_ids.get )
+        with open( os.path.join( state_dir, 'xmers.txt' ), 'w' ) as out_file:
+            out_file.writelines( xmer + '\n' for xmer in xmers )
+    return encode
+
+def read_index( state_dir, meta ):
+    """
+        Reads the sequences and XmerIndex written by write_index
+
+        :returns: list of names, list of sequences, and XmerIndex of the sequences
+    """
+    from scipy import sparse
+
+    names, sequences = oligo.read_fasta_lists( os.path.join( state_dir, 'sequences.fasta' ) )
+    if len( sequences ) != meta[ 'num_items' ]:
+        raise ValueError( "%s does not contain the sequences it was saved with" % state_dir )
+
+    xmer_matrix = sparse.load_npz( os.path.join( state_dir, 'xmer_matrix.npz' ) )
+    xmer_codes = None
+    xmer_ids = None
+    if meta[ 'encode' ]:
+        xmer_codes = np.load( os.path.join( state_dir, 'xmer_codes.npy' ) )
+    else:
+        with open( os.path.join( state_dir, 'xmers.txt' ), 'r' ) as open_file:
+            xmer_ids = { line.rstrip( '\n' ): xmer_id for xmer_id, line in enumerate( open_file ) }
+
+    xmer_index = oligo.XmerIndex.from_matrix( sequences, meta[ 'window_size' ], meta[ 'step_size' ], xmer_matrix,
+                                              xmer_codes, xmer_ids
+                                            )
+    return names, sequences, xmer_index
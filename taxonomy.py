@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import json
+import os
+import numpy as np
+import protein_oligo_library as oligo
+
+SPECIES_TABLE_VERSION = 1
+
+
+class SpeciesTable:
+    """
+        Lookup table from integer taxid to species, held in flat numpy arrays so that it can
+        be memory mapped instead of read into a dictionary on every run. Taxids are sorted,
+        each with the code of its species, and the species names are stored once each, as
+        utf-8 bytes one after another.
+    """
+
+    def __init__( self, taxids, species_codes, name_offsets, name_bytes ):
+        """
+            :param taxids: numpy int64 array of sorted, distinct taxids
+            :param species_codes: numpy array of the species code of each taxid
+            :param name_offsets: numpy int64 array of where the name of each species starts in
+                                 name_bytes, followed by the length of name_bytes
+            :param name_bytes: numpy uint8 array of the utf-8 names of every species
+        """
+        self.taxids = taxids
+        self.species_codes = species_codes
+        self.name_offsets = name_offsets
+        self.name_bytes = name_bytes
+
+    def __len__( self ):
+        """
+            Number of distinct species in the table
+        """
+        return len( self.name_offsets ) - 1
+
+    def lookup( self, taxids ):
+        """
+            Looks up the species of many taxids at once
+
+            :param taxids: numpy integer array of taxids
+            :returns: numpy int64 array of the species code of each taxid, -1 where the taxid
+                      is not in the table
+        """
+        taxids = np.asarray( taxids, dtype = np.int64 )
+        codes = np.full( len( taxids ), -1, dtype = np.int64 )
+        if len( self.taxids ) == 0:
+            return codes
+
+        positions = np.minimum( np.searchsorted( self.taxids, taxids ), len( self.taxids ) - 1 )
+        found = self.taxids[ positions ] == taxids
+        codes[ found ] = self.species_codes[ positions[ found ] ]
+        return codes
+
+    def species_name( self, code ):
+        """
+            :returns: string name of the species with code
+        """
+        return bytes( self.name_bytes[ self.name_offsets[ code ] : self.name_offsets[ code + 1 ] ] ).decode( 'utf-8' )
+
+def build_species_table( species_file, table_dir ):
+    """
+        Compiles a file of taxid|species lines, as read by oligo.get_species_from_file, into
+        a SpeciesTable saved in table_dir. A taxid given more than one species keeps the
+        first one.
+
+        :param species_file: string name of the file to read
+        :param table_dir: string directory to save the table in, created if it does not exist
+
+        :returns: the SpeciesTable
+    """
+    taxid_dict = oligo.get_species_from_file( species_file )
+
+    species_ids = {}
+    taxids = np.fromiter( taxid_dict.keys(), dtype = np.int64, count = len( taxid_dict ) )
+    species_codes = np.empty( len( taxids ), dtype = np.int64 )
+    for index, species_list in enumerate( taxid_dict.values() ):
+        species_codes[ index ] = species_ids.setdefault( species_list[ 0 ], len( species_ids ) )
+
+    order = np.argsort( taxids, kind = 'stable' )
+    taxids = taxids[ order ]
+    species_codes = species_codes[ order ].astype( np.int32 if len( species_ids ) < 2 ** 31 else np.int64 )
+
+    encoded_names = [ name.encode( 'utf-8' ) for name in species_ids ]
+    name_offsets = np.zeros( len( encoded_names ) + 1, dtype = np.int64 )
+    np.cumsum( [ len( name ) for name in encoded_names ], out = name_offsets[ 1: ] )
+    name_bytes = np.frombuffer( b''.join( encoded_names ), dtype = np.uint8 )
+
+    os.makedirs( table_dir, exist_ok = True )
+    for name, array in ( ( 'taxids', taxids ), ( 'species_codes', species_codes ),
+                         ( 'name_offsets', name_offsets ), ( 'names', name_bytes )
+                       ):
+        np.save( os.path.join( table_dir, name + '.npy' ), array )
+
+    # The meta data is written last, so a table without it is incomplete
+    with open( os.path.join( table_dir, 'meta.json' ), 'w' ) as out_file:
+        json.dump( { 'version': SPECIES_TABLE_VERSION, 'num_taxids': len( taxids ),
+                     'num_species': len( encoded_names )
+                   }, out_file
+                 )
+    return SpeciesTable( taxids, species_codes, name_offsets, name_bytes )
+
+def load_species_table( table_dir ):
+    """
+        Memory maps a SpeciesTable saved by build_species_table
+
+        :raises ValueError: if table_dir does not hold a table this version can read
+    """
+    meta_file = os.path.join( table_dir, 'meta.json' )
+    if not os.path.isfile( meta_file ):
+        raise ValueError( "%s does not contain a species table" % table_dir )
+
+    with open( meta_file, 'r' ) as open_file:
+        meta = json.load( open_file )
+    if meta.get( 'version' ) != SPECIES_TABLE_VERSION:
+        raise ValueError( "%s was saved by an incompatible version" % table_dir )
+
+    arrays = [ np.load( os.path.join( table_dir, name + '.npy' ), mmap_mode = 'r' )
+               for name in ( 'taxids', 'species_codes', 'name_offsets', 'names' )
+             ]
+    return SpeciesTable( *arrays )
+
+def species_groups( taxids, table = None ):
+    """
+        Groups sequences by species. Without a table, each taxid is its own species. With one,
+        taxids of the same species share a group, and taxids not in the table keep their own.
+
+        :param taxids: numpy int64 array of the taxid of each sequence, see oligo.taxid_array
+        :param table: optional SpeciesTable
+
+        :returns: numpy int64 array of the species group of each sequence
+    """
+    if table is None:
+        return np.asarray( taxids, dtype = np.int64 )
+
+    groups = table.lookup( taxids )
+    missing = groups < 0
+    if missing.any():
+        missing_codes = np.unique( taxids[ missing ], return_inverse = True )[ 1 ].ravel()
+        groups[ missing ] = len( table ) + missing_codes
+    return groups
+
+def species_label( taxid, table = None ):
+    """
+        Names the species of taxid for reports, by its species name when table has it and
+        by its taxid otherwise
+
+        :returns: string label, None if taxid is oligo.MISSING_TAXID
+    """
+    if taxid == oligo.MISSING_TAXID:
+        return None
+    if table is not None:
+        code = table.lookup( np.array( [ taxid ] ) )[ 0 ]
+        if code >= 0:
+            return table.species_name( code )
+    return str( taxid )